@@ -0,0 +1,358 @@
+import asyncio
+import logging
+import random
+import signal
+import threading
+import time
+
+import aiohttp
+import asyncpraw
+import asyncprawcore
+
+from delivery import TELEGRAM_URL, get_dispatcher
+from main import account_report
+from outbox import Outbox
+from pipeline import AlertPipeline
+import resolver
+from resolver import AccountSweeper
+from scheduler import KINDS, Feed, feed_key, warm_start
+from reddit_observer import auth, governor, observe_item, retry_delay
+from telegram import (
+    STARTUP_MESSAGE,
+    checkpoint_offset,
+    claim_update,
+    get_offset,
+    handle_command,
+    update_command,
+)
+from utils.config import (
+    REDDIT_CLIENT_ID,
+    REDDIT_CLIENT_SECRET,
+    REDDIT_USER_AGENT,
+)
+from utils import archive, seen
+from utils.db import (
+    get_chat_ids,
+    list_redditors_db,
+    load_rules_db,
+    load_subscriptions_db,
+    load_watchlist_db,
+    migrate_db,
+    seed_subscriptions_db,
+)
+from utils.log import log_event, setup_logging
+from utils.metrics import start_metrics_server
+from utils.ratelimit import TokenBucket
+from utils.settings import (
+    ASYNC_MAX_CONCURRENCY,
+    METRICS_HOST,
+    METRICS_PORT,
+    POLL_BUDGET_RPM,
+    POLL_JITTER,
+    RETRY_DELAY,
+    SHUTDOWN_TIMEOUT,
+    TELEGRAM_POLL_TIMEOUT,
+    WATCHLIST_REFRESH_INTERVAL,
+)
+
+log = logging.getLogger("async_main")
+
+# every request of the async client is a feed poll, so each one is charged
+# here like the threaded scheduler charges its polls
+poll_budget = TokenBucket(POLL_BUDGET_RPM / 60, capacity=ASYNC_MAX_CONCURRENCY)
+
+
+class GovernedRequestor(asyncprawcore.Requestor):
+    """Routes asyncpraw requests through the same governor as PRAW"""
+
+    async def request(self, *args, **kwargs):
+        wait = max(governor.reserve(), poll_budget.reserve())
+        if wait > 0:
+            await asyncio.sleep(wait)
+        response = await super().request(*args, **kwargs)
+        governor.update(response.status, response.headers)
+        return response
+
+
+class LoopQueue:
+    """Thread-safe ``put`` into an asyncio.Queue.
+
+    Command handlers in telegram.py run in worker threads and hand new or
+    removed redditors over with ``queue.put``, same as in the threaded mode.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class AsyncEngine:
+    """Runs every feed and the Telegram long poll on one event loop.
+
+    Alerts go through the same AlertPipeline and outbox as the threaded
+    mode, so a failed send is retried instead of lost.
+    """
+
+    def __init__(self, session, reddit, command_reddit):
+        self.session = session
+        self.reddit = reddit
+        self.command_reddit = command_reddit
+        self.stop_event = asyncio.Event()
+        self.reddit_slots = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+        self.telegram_slots = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+        self.feeds = {}
+        self.outbox = None
+        self.pipeline = None
+        loop = asyncio.get_running_loop()
+        # the sweeper is a thread; it checks accounts with the sync client
+        self.sweeper_stop = threading.Event()
+        self.sweeper = AccountSweeper(
+            command_reddit,
+            lambda died, revived: loop.call_soon_threadsafe(
+                self.accounts_changed, died, revived
+            ),
+            self.sweeper_stop,
+        )
+        self.created_redditors_queue = LoopQueue(loop)
+        self.removed_redditors_queue = LoopQueue(loop)
+
+    async def send_message(self, message, chat_ids):
+        return await asyncio.gather(
+            *(self._send_one(message, id) for id in chat_ids)
+        )
+
+    async def broadcast(self, message):
+        """Send ``message`` to every chat in the users table right now"""
+        return await self.send_message(message, await asyncio.to_thread(get_chat_ids))
+
+    async def _send_one(self, message, chat_id):
+        if isinstance(chat_id, (tuple, list)):
+            chat_id = chat_id[0]
+        async with self.telegram_slots:
+            async with self.session.post(
+                f"{TELEGRAM_URL}/sendMessage",
+                data={"chat_id": chat_id, "text": message},
+            ) as response:
+                return await response.json()
+
+    def add(self, redditor, delays=None):
+        """Start polling ``redditor``, first polls after ``delays`` seconds"""
+        delays = delays or warm_start(len(KINDS), 0)
+        for kind, delay in zip(KINDS, delays):
+            key = feed_key(redditor[0], kind)
+            if key not in self.feeds:
+                self.feeds[key] = asyncio.create_task(
+                    self.observe(Feed(redditor, kind), delay)
+                )
+        log_event(log, logging.INFO, "scheduled", redditor=redditor[0])
+
+    def add_many(self, redditors):
+        # one warm start for all of them, highest rated first, like
+        # PollScheduler.add_many
+        redditors = sorted(redditors, key=lambda redditor: -int(redditor[1]))
+        delays = warm_start(len(redditors) * len(KINDS), 0)
+        for index, redditor in enumerate(redditors):
+            self.add(redditor, delays[index * len(KINDS) : (index + 1) * len(KINDS)])
+
+    def remove(self, name):
+        for kind in KINDS:
+            task = self.feeds.pop(feed_key(name, kind), None)
+            if task:
+                task.cancel()
+        asyncio.get_running_loop().run_in_executor(None, seen.forget, name.strip())
+        log_event(log, logging.INFO, "unscheduled", redditor=name)
+
+    def accounts_changed(self, died, revived):
+        for redditor in died:
+            self.remove(redditor[0])
+        for redditor in revived:
+            self.add(redditor)
+        asyncio.create_task(self.broadcast(account_report(died, revived)))
+
+    async def observe(self, feed, delay):
+        # same cadence as PollScheduler: Feed.interval after an empty poll,
+        # right away while the stream hands out items
+        redditor, kind = feed.redditor, feed.kind
+        await self.sleep(delay)
+        while not self.stop_event.is_set():
+            log_event(log, logging.INFO, "stream_started", redditor=redditor[0], kind=kind)
+            try:
+                await asyncio.to_thread(seen.register, redditor[0], kind)
+                listing = getattr(self.reddit.redditor(redditor[0]).stream, kind)
+                stream = listing(pause_after=0)
+                while not self.stop_event.is_set():
+                    async with self.reddit_slots:
+                        item = await stream.__anext__()
+                    if item is not None:
+                        event, alert = await asyncio.to_thread(
+                            observe_item, item, kind, redditor
+                        )
+                        if alert:
+                            self.pipeline.submit(alert)
+                        if event:
+                            feed.record_item(event.created)
+                        continue
+                    await self.sleep(
+                        feed.interval(time.time())
+                        * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(
+                    f"An error occurred in {kind} stream for {redditor[0]}",
+                    exc_info=True,
+                )
+                await self.sleep(retry_delay(e, RETRY_DELAY))
+
+    async def sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def handle_updates(self):
+        await asyncio.to_thread(get_offset)
+        while not self.stop_event.is_set():
+            try:
+                async with self.session.get(
+                    f"{TELEGRAM_URL}/getUpdates",
+                    params={"offset": get_offset() + 1, "timeout": TELEGRAM_POLL_TIMEOUT},
+                    timeout=aiohttp.ClientTimeout(total=TELEGRAM_POLL_TIMEOUT + 10),
+                ) as response:
+                    updates = await response.json()
+                for update in updates["result"]:
+                    if not claim_update(update):
+                        continue
+                    command = update_command(update)
+                    if command:
+                        self.run_command(*command)
+                await asyncio.to_thread(checkpoint_offset)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.error("An error occurred in async update handler", exc_info=True)
+                await self.sleep(RETRY_DELAY)
+
+    def run_command(self, chat_id, update_text):
+        # the handlers in telegram.py are blocking (SQLite, PRAW lookups);
+        # handle_command queues them on its worker pool and returns at once
+        handle_command(
+            chat_id,
+            update_text,
+            self.command_reddit,
+            self.created_redditors_queue,
+            self.removed_redditors_queue,
+        )
+
+    async def handle_new_redditor(self):
+        while True:
+            self.add(await self.created_redditors_queue.get())
+
+    async def handle_removed_redditor(self):
+        while True:
+            self.remove(await self.removed_redditors_queue.get())
+
+    async def still_running(self):
+        sent_message = False
+        last_refresh = time.time()
+        while not self.stop_event.is_set():
+            if time.time() - last_refresh > WATCHLIST_REFRESH_INTERVAL:
+                await asyncio.to_thread(seed_subscriptions_db)
+                await asyncio.to_thread(load_subscriptions_db)
+                last_refresh = time.time()
+            if time.localtime().tm_hour == 22 and not sent_message:
+                print(await self.broadcast("🕒Still running hihi🏃‍♂️‍➡️"))
+                sent_message = True
+            if time.localtime().tm_hour != 22:
+                sent_message = False
+            await self.sleep(60)
+
+    async def run(self):
+        await asyncio.to_thread(load_watchlist_db)
+        await asyncio.to_thread(seen.load)
+        await asyncio.to_thread(archive.start)
+        await asyncio.to_thread(load_rules_db)
+        await asyncio.to_thread(seed_subscriptions_db)
+        await asyncio.to_thread(load_subscriptions_db)
+        await asyncio.to_thread(resolver.load)
+        redditors = [
+            redditor
+            for redditor in await asyncio.to_thread(list_redditors_db) or []
+            if not resolver.is_dead(redditor[0])
+        ]
+        # anything left pending by the last run goes out as soon as this starts
+        self.outbox = await asyncio.to_thread(Outbox)
+        self.outbox.start()
+        self.pipeline = AlertPipeline(self.outbox)
+        self.pipeline.start()
+        await self.broadcast(STARTUP_MESSAGE)
+        self.add_many(redditors)
+        self.sweeper.start()
+
+        background = [
+            asyncio.create_task(self.handle_updates()),
+            asyncio.create_task(self.handle_new_redditor()),
+            asyncio.create_task(self.handle_removed_redditor()),
+            asyncio.create_task(self.still_running()),
+        ]
+        await self.stop_event.wait()
+
+        # everything below shares one SHUTDOWN_TIMEOUT
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+
+        def left():
+            return max(0, deadline - time.monotonic())
+
+        self.sweeper_stop.set()
+        governor.stop()
+        print("cancelling tasks")
+        tasks = background + list(self.feeds.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        print("tasks cancelled")
+        # queued alerts go to the outbox and are sent on the next start if
+        # Telegram does not take them before the deadline
+        await asyncio.to_thread(self.pipeline.close, left())
+        await asyncio.to_thread(archive.close)
+        await asyncio.to_thread(checkpoint_offset, True)
+        await asyncio.to_thread(self.outbox.close, left())
+        await self.broadcast("shutting down⛔")
+        await asyncio.to_thread(get_dispatcher().close, left())
+
+
+async def run_async():
+    reddit = asyncpraw.Reddit(
+        client_id=REDDIT_CLIENT_ID,
+        client_secret=REDDIT_CLIENT_SECRET,
+        user_agent=REDDIT_USER_AGENT,
+        requestor_class=GovernedRequestor,
+    )
+    try:
+        async with aiohttp.ClientSession() as session:
+            engine = AsyncEngine(session, reddit, auth())
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, engine.stop_event.set)
+            await engine.run()
+    finally:
+        await reddit.close()
+
+
+def main():
+    setup_logging()
+    migrate_db()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, METRICS_PORT)
+    asyncio.run(run_async())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Compare open-per-call SQLite access with the pooled connections in utils/db.py.
+
+Run from the repository root: python -m bench.bench_db [calls] [threads]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from utils import db
+
+
+def open_per_call_is_muted(redditor):
+    # the access pattern utils/db.py used before the connection layer
+    with sqlite3.connect(db.DB_PATH) as connection:
+        cursor = connection.cursor()
+        sql_statement = "SELECT mute_timer FROM redditors WHERE user_name = ? COLLATE NOCASE;"
+        cursor.execute(sql_statement, (redditor,))
+        user_mute_timer = cursor.fetchone()
+        return float(user_mute_timer[0]) > time.time()
+
+
+def pooled_is_muted(redditor):
+    with db.read_connection() as connection:
+        cursor = connection.cursor()
+        sql_statement = "SELECT mute_timer FROM redditors WHERE user_name = ? COLLATE NOCASE;"
+        cursor.execute(sql_statement, (redditor,))
+        user_mute_timer = cursor.fetchone()
+        return float(user_mute_timer[0]) > time.time()
+
+
+def create_db(path, redditors):
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "CREATE TABLE redditors (id INTEGER PRIMARY KEY, user_name TEXT, rating INTEGER, mute_timer REAL);"
+        )
+        connection.executemany(
+            "INSERT INTO redditors (user_name, rating, mute_timer) VALUES (?, 1, 0);",
+            [(f"redditor{i}",) for i in range(redditors)],
+        )
+
+
+def run(function, calls, threads, redditors):
+    def worker():
+        for i in range(calls):
+            function(f"redditor{i % redditors}")
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    redditors = 500
+    with tempfile.TemporaryDirectory() as directory:
+        db.DB_PATH = os.path.join(directory, "bench.db")
+        create_db(db.DB_PATH, redditors)
+        db.migrate_db()
+        total = calls * threads
+        for name, function in (
+            ("open per call", open_per_call_is_muted),
+            ("pooled", pooled_is_muted),
+        ):
+            elapsed = run(function, calls, threads, redditors)
+            print(
+                f"{name:>14}: {total} calls in {elapsed:.3f}s "
+                f"({elapsed / total * 1e6:.1f} us/call)"
+            )
+
+        start = time.perf_counter()
+        for i in range(calls):
+            db.give_rockets_db(f"redditor{i % redditors}", 1)
+        elapsed = time.perf_counter() - start
+        print(f"{'pooled writes':>14}: {calls} calls in {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""PRAW-compatible stand-in that replays synthetic comments and submissions.
+
+Each redditor posts as a Poisson process with the given rate. Streams behave
+like PRAW's ``stream.comments(pause_after=0)``: the first fetch returns the
+listing's existing items (up to ``history``, posted before the stream
+started) along with anything new, then they yield buffered items one at a
+time, "fetch" when the buffer is empty and yield None if nothing new turned
+up.
+"""
+import asyncio
+import itertools
+import random
+import threading
+import time
+
+
+class FakeSubredditRef:
+    __slots__ = ("display_name",)
+
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class FakeAuthor:
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeItem:
+    """Carries the attributes the observers read from comments and submissions"""
+
+    def __init__(self, fullname, author, kind, created_utc, subreddit):
+        self.id = fullname.split("_", 1)[1]
+        self.fullname = fullname
+        self.author = FakeAuthor(author)
+        self.created_utc = created_utc
+        self.created = created_utc
+        self.subreddit = FakeSubredditRef(subreddit)
+        self.subreddit_name_prefixed = f"r/{subreddit}"
+        self.is_submitter = False
+        self.score = 1
+        self.permalink = f"/r/{subreddit}/comments/{self.id}/bench/"
+        self.url = f"https://www.reddit.com{self.permalink}"
+        self.link_id = f"t3_{self.id}"
+        self.title = f"bench {fullname}"
+        self.body = f"bench {fullname}"
+        self.selftext = ""
+        self.kind = kind
+
+
+class ActivityModel:
+    """Generates items for every redditor and remembers when each was posted"""
+
+    def __init__(
+        self, redditors, rate_per_hour, subreddit="wallstreetbets", seed=1, history=100
+    ):
+        self.rate = rate_per_hour / 3600
+        self.subreddit = subreddit
+        self.history = history
+        self.random = random.Random(seed)
+        self.created = {}
+        self.requests = 0
+        # called before every fetch, like GovernedRequestor before a request
+        self.on_request = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        now = time.time()
+        self._next = {
+            (name, kind): now + self._gap()
+            for name in redditors
+            for kind in ("comments", "submissions")
+        }
+
+    def _gap(self):
+        return self.random.expovariate(self.rate) if self.rate > 0 else float("inf")
+
+    def _item(self, name, kind, created_utc):
+        prefix = "t1" if kind == "comments" else "t3"
+        fullname = f"{prefix}_{next(self._ids):x}"
+        return FakeItem(fullname, name, kind, created_utc, self.subreddit)
+
+    def backlog(self, names, kind):
+        """The newest ``history`` items ``names`` posted before now, oldest first.
+
+        Made up on every call like a fresh listing page; they are not in
+        ``created`` since their latency means nothing.
+        """
+        rate = self.rate * len(names)
+        if not rate:
+            return []
+        found = []
+        with self._lock:
+            created = time.time()
+            for _ in range(self.history):
+                created -= self.random.expovariate(rate)
+                found.append(self._item(self.random.choice(names), kind, created))
+        found.reverse()
+        return found
+
+    def fetch(self, name, kind, request=True):
+        """Items ``name`` posted since the last fetch, oldest first"""
+        if request and self.on_request:
+            self.on_request()
+        now = time.time()
+        found = []
+        with self._lock:
+            if request:
+                self.requests += 1
+            due = self._next[(name, kind)]
+            while due <= now:
+                item = self._item(name, kind, due)
+                found.append(item)
+                self.created[item.fullname] = due
+                due += self._gap()
+            self._next[(name, kind)] = due
+        return found
+
+
+def _stream(fetch, backlog):
+    buffer = backlog() + fetch()
+    while True:
+        if not buffer:
+            buffer = fetch()
+            if not buffer:
+                yield None
+                continue
+        yield buffer.pop(0)
+
+
+class _RedditorStream:
+    def __init__(self, model, name):
+        self.model = model
+        self.name = name
+
+    def comments(self, **kwargs):
+        return _stream(
+            lambda: self.model.fetch(self.name, "comments"),
+            lambda: self.model.backlog([self.name], "comments"),
+        )
+
+    def submissions(self, **kwargs):
+        return _stream(
+            lambda: self.model.fetch(self.name, "submissions"),
+            lambda: self.model.backlog([self.name], "submissions"),
+        )
+
+
+class _SubredditStream:
+    def __init__(self, model):
+        self.model = model
+
+    def _fetch_all(self, kind):
+        # one listing request covers every redditor in the subreddit
+        if self.model.on_request:
+            self.model.on_request()
+        with self.model._lock:
+            self.model.requests += 1
+        items = []
+        for name, item_kind in list(self.model._next):
+            if item_kind == kind:
+                items.extend(self.model.fetch(name, kind, request=False))
+        return sorted(items, key=lambda item: item.created_utc)
+
+    def _backlog(self, kind):
+        # the subreddit's listing mixes every watched redditor's items
+        names = sorted({name for name, item_kind in self.model._next if item_kind == kind})
+        return self.model.backlog(names, kind)
+
+    def comments(self, **kwargs):
+        return _stream(
+            lambda: self._fetch_all("comments"), lambda: self._backlog("comments")
+        )
+
+    def submissions(self, **kwargs):
+        return _stream(
+            lambda: self._fetch_all("submissions"),
+            lambda: self._backlog("submissions"),
+        )
+
+
+class _Redditor:
+    def __init__(self, model, name):
+        self.name = name
+        self.fullname = f"t2_{name}"
+        self.stream = _RedditorStream(model, name)
+
+
+class _PartialRedditor:
+    def __init__(self, fullname):
+        self.fullname = fullname
+
+
+class _Redditors:
+    def partial_redditors(self, fullnames):
+        # every fake account exists
+        return [_PartialRedditor(fullname) for fullname in fullnames]
+
+
+class _Subreddit:
+    def __init__(self, model):
+        self.stream = _SubredditStream(model)
+
+
+class FakeReddit:
+    def __init__(self, model):
+        self.model = model
+        self.redditors = _Redditors()
+
+    def redditor(self, name):
+        return _Redditor(self.model, name)
+
+    def subreddit(self, name):
+        return _Subreddit(self.model)
+
+
+async def _async_stream(model, stream, reserve):
+    # the sync stream runs on the event loop thread, so a change of
+    # model.requests during next() is this stream's own fetch
+    while True:
+        requests = model.requests
+        item = next(stream)
+        if reserve and model.requests != requests:
+            wait = reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        yield item
+
+
+class _AsyncRedditorStream:
+    def __init__(self, model, name, reserve):
+        self.model = model
+        self.sync = _RedditorStream(model, name)
+        self.reserve = reserve
+
+    def comments(self, **kwargs):
+        return _async_stream(self.model, self.sync.comments(), self.reserve)
+
+    def submissions(self, **kwargs):
+        return _async_stream(self.model, self.sync.submissions(), self.reserve)
+
+
+class _AsyncRedditor:
+    def __init__(self, model, name, reserve):
+        self.name = name
+        self.stream = _AsyncRedditorStream(model, name, reserve)
+
+
+class FakeAsyncReddit:
+    """asyncpraw-shaped client over the same model.
+
+    ``reserve`` stands in for the requestor's poll budget: it is called for
+    every fetch and returns the seconds to wait.
+    """
+
+    def __init__(self, model, reserve=None):
+        self.model = model
+        self.reserve = reserve
+
+    def redditor(self, name):
+        return _AsyncRedditor(self.model, name, self.reserve)
@@ -0,0 +1,101 @@
+"""Local Telegram Bot API stand-in that records sendMessage and edit calls.
+
+It can add latency to every call and answer a share of calls with 429.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+BENCH_ID = re.compile(r"bench (t[13]_[0-9a-f]+)")
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=1, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.delivered = []
+        self._received = set()
+        self.calls = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                params = {
+                    key: values[0]
+                    for key, values in parse_qs(self.rfile.read(length).decode()).items()
+                }
+                body = json.dumps(fake.handle(self.path.rsplit("/", 1)[-1], params))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def do_GET(self):
+                # getUpdates: no updates, after holding the long poll a while
+                query = parse_qs(urlsplit(self.path).query)
+                time.sleep(min(float(query.get("timeout", ["0"])[0]), 1))
+                body = json.dumps({"ok": True, "result": []})
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body.encode())
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up on the long poll while stopping
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def handle(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.throttled += 1
+                return {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            if method in ("sendMessage", "editMessageText"):
+                # a digest edit repeats the items already delivered in it
+                chat_id = params.get("chat_id")
+                for fullname in BENCH_ID.findall(params.get("text", "")):
+                    if (fullname, chat_id) not in self._received:
+                        self._received.add((fullname, chat_id))
+                        self.delivered.append((fullname, chat_id, time.time()))
+            return {"ok": True, "result": {"message_id": self.calls}}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,116 @@
+"""Check that the hot queries in utils/db.py are served by an index.
+
+Builds a wsbwatch.db with migrate_db() in a temporary directory, calls every
+utils/db.py function that runs per item, per alert or per command, records
+the SQL they actually execute with the connection's trace callback, runs
+EXPLAIN QUERY PLAN on each statement and exits non-zero if any of them scans
+a whole table. Plain SELECTs without a WHERE clause load a whole table on
+purpose (load_rules_db after a rule change, ...) and are not checked.
+
+    python -m bench.query_plans
+"""
+import os
+import sys
+import tempfile
+
+from utils import db
+
+# (function, arguments) for the calls on the hot paths
+HOT_CALLS = (
+    (db.add_redditor_db, ("a", 5)),
+    (db.add_redditor_db, ("A", 6)),
+    (db.mute_redditor_db, ("a", 1)),
+    (db.is_muted, ("a",)),
+    (db.unmute_redditor_db, ("a",)),
+    (db.give_rockets_db, ("a", 1)),
+    (db.get_rating, ("a",)),
+    (db.add_bot_user_db, ("user", 1)),
+    (db.remove_bot_user_db, ("user",)),
+    (db.save_offset_db, (1,)),
+    (db.get_offset_db, ()),
+    (db.save_seen_db, ("a", "comments", "t1_b", 2.0, "t1_a")),
+    (db.save_watermark_db, ("a", "submissions", 1.0)),
+    (db.append_outbox_db, ([(1, "text", 0.0, "sendMessage", None)],)),
+    (db.count_outbox_db, ()),
+    (db.due_outbox_chats_db, (0,)),
+    (db.pending_outbox_db, (1, 50)),
+    (db.retry_outbox_db, (1, 0)),
+    (db.mark_outbox_db, (1, "sent", 1)),
+    (db.digest_message_db, (1, "d")),
+    (db.prune_outbox_db, (0,)),
+    (db.subscribe_db, (1, "a")),
+    (db.unsubscribe_db, (1, "a")),
+    (db.add_rule_db, ("min_score", "5")),
+    (db.add_rule_db, ("ticker", "TSLA")),
+    (db.remove_rule_db, ("ticker", "TSLA")),
+    (
+        db.append_archive_db,
+        ([("t1_a", "a", "comments", "wsb", 1.0, "", "tsla", "/r/wsb", "", 1)],),
+    ),
+    (db.search_archive_db, ('"tsla"', "a")),
+    (db.prune_archive_db, (0,)),
+    (db.save_accounts_db, ([("a", "t2_a", 1, 0.0)],)),
+    (db.remove_seen_db, ("a",)),
+    (db.remove_redditor_db, ("a",)),
+)
+
+# transaction control, and the "-- TRIGGER name" lines traced for triggers
+SKIPPED = ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "--")
+
+
+def capture(connection, calls):
+    """The distinct statements ``calls`` execute, in order"""
+    statements = []
+    connection.set_trace_callback(statements.append)
+    try:
+        for function, args in calls:
+            function(*args)
+    finally:
+        connection.set_trace_callback(None)
+    return list(
+        dict.fromkeys(
+            statement.strip()
+            for statement in statements
+            if not statement.lstrip().upper().startswith(SKIPPED)
+        )
+    )
+
+
+def is_load(statement):
+    words = statement.upper()
+    return words.startswith("SELECT") and " WHERE " not in words
+
+
+def full_scans(connection, statement):
+    plan = connection.execute("EXPLAIN QUERY PLAN " + statement).fetchall()
+    return [
+        row[3]
+        for row in plan
+        if row[3].startswith("SCAN ")
+        and "USING" not in row[3]
+        and "VIRTUAL TABLE" not in row[3]
+    ]
+
+
+def main():
+    failed = 0
+    with tempfile.TemporaryDirectory() as directory:
+        db.DB_PATH = os.path.join(directory, "wsbwatch.db")
+        version = db.migrate_db()
+        print(f"schema version {version}")
+        connection = db.get_connection()
+        for statement in capture(connection, HOT_CALLS):
+            if is_load(statement):
+                print(f"load: {statement}")
+                continue
+            scans = full_scans(connection, statement)
+            if scans:
+                failed += 1
+                print(f"FULL SCAN ({', '.join(scans)}): {statement}")
+            else:
+                print(f"ok: {statement}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Offline load benchmark for the observer and delivery pipeline.
+
+Runs the real scheduler (or subreddit watcher), dedup store, SQLite layer and
+Telegram dispatcher against bench.fake_reddit and bench.fake_telegram, so no
+credentials or network are needed. Reports end-to-end alert latency (item
+posted -> Telegram received), throughput, threads, RSS, Reddit requests and
+SQLite calls per alert.
+
+    python -m bench.run --redditors 1000 --rate 6 --duration 60
+
+``--mode async`` runs async_main.AsyncEngine instead, which needs aiohttp
+and asyncpraw.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from bench.fake_reddit import ActivityModel, FakeAsyncReddit, FakeReddit
+from bench.fake_telegram import FakeTelegram
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redditors", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=6.0, help="items per redditor per hour, per kind")
+    parser.add_argument("--history", type=int, default=100, help="items already in each listing at startup")
+    parser.add_argument("--chats", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--mode", choices=("user", "subreddit", "async"), default="user")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--min-interval", type=float, default=2.0)
+    parser.add_argument("--max-interval", type=float, default=30.0)
+    parser.add_argument("--budget-rpm", type=float, default=1e9)
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--telegram-429", type=float, default=0.0, help="share of calls")
+    parser.add_argument("--chat-interval", type=float, default=0.0)
+    parser.add_argument("--global-rate", type=float, default=1000.0)
+    parser.add_argument("--policy", choices=("coalesce", "drop_lowest", "spill"), default="coalesce")
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--max-pending", type=int, default=200, help="sends waiting in the outbox")
+    parser.add_argument("--drain", type=float, default=10.0, help="seconds to let the delivery backlog drain")
+    parser.add_argument("--json", action="store_true")
+    return parser.parse_args(argv)
+
+
+def install_config(args, telegram_url, directory=None):
+    # stands in for utils/config.py so the run never touches real credentials
+    config = types.ModuleType("utils.config")
+    config.REDDIT_CLIENT_ID = "bench"
+    config.REDDIT_CLIENT_SECRET = "bench"
+    config.REDDIT_USER_AGENT = "redditwatch-bench"
+    config.TELEGRAM_BOT_TOKEN = "bench"
+    config.TELEGRAM_API_URL = telegram_url
+    config.FETCH_MODE = args.mode
+    config.POLLER_WORKERS = args.workers
+    config.POLL_MIN_INTERVAL = args.min_interval
+    config.POLL_MAX_INTERVAL = args.max_interval
+    config.POLL_BUDGET_RPM = args.budget_rpm
+    config.SUBREDDIT_POLL_INTERVAL = args.min_interval
+    config.TELEGRAM_CHAT_INTERVAL = args.chat_interval
+    config.TELEGRAM_GLOBAL_RATE = args.global_rate
+    config.DELIVERY_MAX_PENDING = args.max_pending
+    config.METRICS_PORT = None
+    config.SHUTDOWN_TIMEOUT = args.drain
+    config.PIPELINE_POLICY = args.policy
+    config.PIPELINE_QUEUE_SIZE = args.queue_size
+    config.PIPELINE_SPILL_PATH = os.path.join(
+        directory or tempfile.gettempdir(), "alert_spill.jsonl"
+    )
+    sys.modules["utils.config"] = config
+
+
+def create_db(path, names, chats):
+    with sqlite3.connect(path) as connection:
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS redditors (id INTEGER PRIMARY KEY, user_name TEXT, rating INTEGER, mute_timer REAL);
+            CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT, chat_id INTEGER);
+            CREATE TABLE IF NOT EXISTS offset (id INTEGER PRIMARY KEY, offset INTEGER);
+            """
+        )
+        connection.executemany(
+            "INSERT INTO redditors (user_name, rating, mute_timer) VALUES (?, ?, 0);",
+            [(name, 1 + index % 10) for index, name in enumerate(names)],
+        )
+        connection.executemany(
+            "INSERT INTO users (name, chat_id) VALUES (?, ?);",
+            [(f"chat{chat}", 1000 + chat) for chat in range(chats)],
+        )
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def run_async_engine(args, model, reddit):
+    """Run AsyncEngine for ``args.duration``; returns it and the peak threads"""
+    import aiohttp
+
+    from async_main import AsyncEngine, poll_budget
+
+    peak_threads = 0
+
+    async def main():
+        nonlocal peak_threads
+        async with aiohttp.ClientSession() as session:
+            engine = AsyncEngine(
+                session, FakeAsyncReddit(model, poll_budget.reserve), reddit
+            )
+
+            async def stop_after_duration():
+                nonlocal peak_threads
+                until = time.time() + args.duration
+                while time.time() < until:
+                    peak_threads = max(peak_threads, threading.active_count())
+                    await asyncio.sleep(0.5)
+                engine.stop_event.set()
+
+            stopper = asyncio.create_task(stop_after_duration())
+            await engine.run()
+            await stopper
+            return engine
+
+    engine = asyncio.run(main())
+    return engine, peak_threads
+
+
+def run(args):
+    telegram = FakeTelegram(latency=args.telegram_latency, error_rate=args.telegram_429)
+    telegram.start()
+    directory = tempfile.mkdtemp(prefix="redditwatch-bench-")
+    install_config(args, telegram.url, directory)
+    logging.basicConfig(level=logging.WARNING)
+
+    from utils import db
+
+    db.DB_PATH = os.path.join(directory, "wsbwatch.db")
+    names = [f"redditor{index}" for index in range(args.redditors)]
+    create_db(db.DB_PATH, names, args.chats)
+
+    from delivery import get_dispatcher
+    from outbox import Outbox
+    from pipeline import AlertPipeline, coalesced, dropped
+    from scheduler import PollScheduler
+    from subreddit_observer import SubredditWatcher
+    from utils import archive, metrics, seen
+
+    db.migrate_db()
+    db.load_watchlist_db()
+    db.init_rules_db()
+    db.load_rules_db()
+    db.seed_subscriptions_db()
+    db.load_subscriptions_db()
+    model = ActivityModel(names, args.rate, history=args.history)
+    reddit = FakeReddit(model)
+    start = time.time()
+
+    if args.mode == "async":
+        # the engine loads its state, runs the pipeline and outbox and shuts
+        # them down itself
+        observer, peak_threads = run_async_engine(args, model, reddit)
+        pipeline = observer.pipeline
+        undelivered = observer.outbox.pending()
+    else:
+        from reddit_observer import charge_poll
+
+        model.on_request = charge_poll
+        seen.load()
+        archive.start()
+        stop_event = threading.Event()
+        outbox = Outbox()
+        outbox.start()
+        pipeline = AlertPipeline(outbox)
+        pipeline.start()
+        if args.mode == "subreddit":
+            observer = SubredditWatcher(reddit, pipeline, stop_event)
+            for redditor in db.list_redditors_db():
+                observer.add(redditor)
+        else:
+            observer = PollScheduler(reddit, pipeline, stop_event)
+            observer.add_many(db.list_redditors_db())
+        observer.start()
+
+        peak_threads = 0
+        while time.time() - start < args.duration:
+            peak_threads = max(peak_threads, threading.active_count())
+            time.sleep(0.5)
+        stop_event.set()
+        observer.join()
+        archive.close()
+        pipeline.close(timeout=args.drain)
+        drain_until = time.time() + args.drain
+        while outbox.pending() and time.time() < drain_until:
+            time.sleep(0.1)
+        undelivered = outbox.close(timeout=args.drain)
+        get_dispatcher().close(timeout=args.drain)
+    elapsed = time.time() - start
+    telegram.stop()
+
+    latencies = [
+        received - model.created[fullname]
+        for fullname, _, received in telegram.delivered
+        if fullname in model.created
+    ]
+    alerts = len({fullname for fullname, _, _ in telegram.delivered})
+    db_calls = sum(counts[1] for counts in metrics.db_seconds.values.values())
+    return {
+        "mode": args.mode,
+        "redditors": args.redditors,
+        "chats": args.chats,
+        "seconds": round(elapsed, 1),
+        "items_posted": len(model.created),
+        "alerts": alerts,
+        "messages_delivered": len(telegram.delivered),
+        "messages_per_second": round(len(telegram.delivered) / elapsed, 2),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "reddit_requests": model.requests,
+        "telegram_calls": telegram.calls,
+        "telegram_429s": telegram.throttled,
+        "undelivered_messages": undelivered,
+        "alerts_on_disk": pipeline.pending(),
+        "alerts_dropped": sum(dropped.values.values()),
+        "alerts_coalesced": coalesced.value(),
+        "time_to_armed": round(observer.armed_after, 1)
+        if getattr(observer, "armed_after", None)
+        else None,
+        "peak_threads": peak_threads,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "sqlite_calls_per_alert": round(db_calls / alerts, 2) if alerts else None,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.json:
+        print(json.dumps(report))
+        return
+    for key, value in report.items():
+        if isinstance(value, float) and key.startswith("latency"):
+            value = f"{value:.3f}s"
+        print(f"{key:>24}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.config import TELEGRAM_BOT_TOKEN
+from utils import metrics
+from utils.executors import KeyedExecutor
+from utils.log import log_event
+from utils.ratelimit import TokenBucket
+from utils.settings import (
+    DELIVERY_RETRIES,
+    DELIVERY_WORKERS,
+    TELEGRAM_API_URL,
+    TELEGRAM_CHAT_INTERVAL,
+    TELEGRAM_GLOBAL_RATE,
+)
+
+TELEGRAM_URL = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}"
+
+log = logging.getLogger("delivery")
+
+
+def chat_key(chat_id):
+    # get_chat_ids() returns rows like (chat_id,)
+    if isinstance(chat_id, (tuple, list)):
+        return chat_id[0]
+    return chat_id
+
+
+class Dispatcher:
+    """Sends Telegram messages over one keep-alive session.
+
+    Messages for the same chat go out in order, at most one per
+    TELEGRAM_CHAT_INTERVAL seconds. All chats share a TELEGRAM_GLOBAL_RATE
+    per second budget, and a 429 holds the chat back for ``retry_after``
+    seconds before the message is retried.
+    """
+
+    def __init__(self, workers=DELIVERY_WORKERS):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE)
+        self.executor = KeyedExecutor(workers, "delivery")
+        self._chat_ready = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, message, chat_ids):
+        """Queue ``message`` for every chat and return without waiting"""
+        return [
+            self.executor.submit(chat_key(id), self.send, message, chat_key(id))
+            for id in chat_ids
+        ]
+
+    def broadcast(self, message, chat_ids):
+        """Send ``message`` to every chat concurrently and wait for the results"""
+        return [future.result() for future in self.enqueue(message, chat_ids)]
+
+    def send(self, message, chat_id):
+        return self.call("sendMessage", chat_id, {"chat_id": chat_id, "text": message})
+
+    def call(self, method, chat_id, params):
+        response = None
+        for attempt in range(DELIVERY_RETRIES + 1):
+            self._wait_for_chat(chat_id)
+            self.global_bucket.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.post(
+                    f"{TELEGRAM_URL}/{method}", data=params, timeout=30
+                ).json()
+            except (requests.RequestException, ValueError):
+                metrics.telegram_errors.inc(reason="network")
+                logging.error(f"telegram {method} to {chat_id} failed", exc_info=True)
+                time.sleep(2**attempt)
+                continue
+            finally:
+                metrics.telegram_seconds.observe(
+                    time.perf_counter() - start, method=method
+                )
+            if response.get("error_code") != 429:
+                if not response.get("ok", True):
+                    metrics.telegram_errors.inc(reason="api")
+                return response
+            metrics.telegram_errors.inc(reason="rate_limited")
+            retry_after = response.get("parameters", {}).get("retry_after", 1)
+            log_event(
+                log,
+                logging.WARNING,
+                "telegram_rate_limited",
+                chat_id=chat_id,
+                retry_after=retry_after,
+            )
+            self._hold_chat(chat_id, retry_after)
+        return response
+
+    def _wait_for_chat(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            ready = max(now, self._chat_ready.get(chat_id, 0.0))
+            self._chat_ready[chat_id] = ready + TELEGRAM_CHAT_INTERVAL
+        if ready > now:
+            time.sleep(ready - now)
+
+    def _hold_chat(self, chat_id, seconds):
+        with self._lock:
+            self._chat_ready[chat_id] = max(
+                self._chat_ready.get(chat_id, 0.0), time.monotonic() + seconds
+            )
+
+    def close(self, timeout=None):
+        """Stop delivering, waiting up to ``timeout`` seconds for the backlog"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.executor.pending() and (
+            deadline is None or time.monotonic() < deadline
+        ):
+            time.sleep(0.1)
+        dropped = self.executor.cancel_pending()
+        if dropped:
+            log_event(log, logging.WARNING, "delivery_dropped", messages=dropped)
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        return dropped
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+metrics.Gauge(
+    "redditwatch_delivery_pending",
+    "Telegram messages waiting to be sent",
+    function=lambda: _dispatcher.executor.pending() if _dispatcher else 0,
+)
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher()
+        return _dispatcher
@@ -1,19 +1,46 @@
 import threading
 import signal
-from telegram import send_message, handle_updates
-from utils.db import get_chat_ids, list_redditors_db
-from reddit_observer import auth, observe_submissions, observe_comments
+from telegram import (
+    STARTUP_MESSAGE,
+    checkpoint_offset,
+    feed_sources,
+    handle_updates,
+    send_message,
+)
+from delivery import get_dispatcher
+from outbox import Outbox
+from pipeline import AlertPipeline
+import resolver
+from resolver import AccountSweeper
+from utils.db import (
+    get_chat_ids,
+    list_redditors_db,
+    load_rules_db,
+    load_subscriptions_db,
+    load_watchlist_db,
+    migrate_db,
+    seed_subscriptions_db,
+)
+from reddit_observer import auth, governor
+from scheduler import PollScheduler
+from subreddit_observer import SubredditWatcher
+from utils.log import setup_logging
+from utils.metrics import start_metrics_server
+from utils.settings import (
+    FETCH_MODE,
+    METRICS_HOST,
+    METRICS_PORT,
+    RETRY_DELAY,
+    SHUTDOWN_TIMEOUT,
+    TELEGRAM_MODE,
+    WATCHLIST_REFRESH_INTERVAL,
+)
+from webhook import WebhookServer
+from utils import archive, seen
 import time
 import queue
-import logging
 import traceback
-import gc
 
-logging.basicConfig(
-    level=logging.ERROR,
-    filename="utils/errors.log",
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
 
 STOP_EVENT = threading.Event()
 
@@ -23,115 +50,41 @@ def handle_shutdown_signal(signum, frame):
     STOP_EVENT.set()
 
 
-def observe_submission_loop(reddit, redditor, chat_ids, stop_event, thread_exit_event):
-    submission_stream = None
-    try:
-        while not stop_event.is_set() and not thread_exit_event.is_set():
-            print(f"started submission thread: {redditor[0]}")
-            try:
-                submission_stream = reddit.redditor(redditor[0]).stream.submissions(
-                    skip_existing=True,
-                    pause_after=0,
-                )
-                while not stop_event.is_set() and not thread_exit_event.is_set():
-                    message = observe_submissions(submission_stream, redditor)
-                    if message:
-                        send_message(message, chat_ids)
-                    time.sleep(30)
-            except Exception as e:
-                print(f"Error with submission stream for {redditor[0]}: {e}")
-                logging.error(
-                    f"An error occurred in submission stream for {redditor[0]}",
-                    exc_info=True,
-                )
-                submission_stream = None
-                gc.collect()
-                # Optional: short delay before retrying
-                time.sleep(10)
-    except Exception as e:
-        print(f"Stream error for {redditor[0]}: {e}")
-        logging.error(
-            f"An error occurred in observe submissions LOOP for {redditor[0]}",
-            exc_info=True,
-        )
-        return
-
-
-
-def observe_comments_loop(reddit, redditor, chat_ids, stop_event, thread_exit_event):
-    comment_stream = None
-    try:
-        while not stop_event.is_set() and not thread_exit_event.is_set():
-            print(f"started comments thread: {redditor[0]}")
-            try:
-                comment_stream = reddit.redditor(redditor[0]).stream.comments(
-                    skip_existing=True,
-                    pause_after=0,
-                )
-                while not stop_event.is_set() and not thread_exit_event.is_set():
-                    message = observe_comments(comment_stream, redditor)
-                    if message:
-                        send_message(message, chat_ids)
-                    time.sleep(30)
-            except Exception as e:
-                print(f"Error with comments stream for {redditor[0]}: {e}")
-                logging.error(
-                    f"An error occurred in comments stream for {redditor[0]}",
-                    exc_info=True,
-                )
-                # Optional: short delay before retrying
-                time.sleep(10)
-    except Exception as e:
-        print(f"Stream error for {redditor[0]}: {e}")
-        logging.error(
-            f"An error occurred in observe comments LOOP for {redditor[0]}",
-            exc_info=True,
-        )
-        comment_stream = None
-        gc.collect()
-        return
-
-
 def handle_update_loop(
     stop_event, reddit, created_redditors_queue, removed_redditor_queue
 ):
     try:
         while not stop_event.is_set():
-            handle_updates(reddit, created_redditors_queue, removed_redditor_queue)
+            if not handle_updates(
+                reddit, created_redditors_queue, removed_redditor_queue
+            ):
+                stop_event.wait(RETRY_DELAY)
     except Exception as e:
         print(f"Exception in handle update loop: {e}")
 
 
-def handle_new_redditor(created_redditors_queue, threads, stop_event, chat_ids, reddit):
+def watch_redditor(redditor, scheduler, watcher):
+    watch_redditors([redditor], scheduler, watcher)
+
+
+def watch_redditors(redditors, scheduler, watcher):
+    polled = []
+    for redditor in redditors:
+        if watcher and watcher.handles(redditor[0]):
+            watcher.add(redditor)
+        else:
+            polled.append(redditor)
+    # one call so the scheduler can stagger the first polls of all of them
+    scheduler.add_many(polled)
+
+
+def handle_new_redditor(created_redditors_queue, scheduler, watcher, stop_event):
     while not stop_event.is_set():
         try:
-            thread_exit_event = threading.Event()
             redditor = created_redditors_queue.get(timeout=10)
-            thread_submission = threading.Thread(
-                target=observe_submission_loop,
-                args=(reddit, redditor, chat_ids, stop_event, thread_exit_event),
-            )
-            thread_submission.daemon = True
-            thread_submission.name = redditor[0]
-
-            thread_submission.start()
-
-            thread_comment = threading.Thread(
-                target=observe_comments_loop,
-                args=(reddit, redditor, chat_ids, stop_event, thread_exit_event),
-            )
-            thread_comment.daemon = True
-            thread_comment.name = redditor[0]
-
-            thread_comment.start()
-            threads.append(
-                {
-                    "name": redditor[0],
-                    "threads": [thread_submission, thread_comment],
-                    "exit_event": thread_exit_event,
-                }
-            )
-            print(f"started thread for {redditor}")
+            if redditor is None:
+                break
+            watch_redditor(redditor, scheduler, watcher)
         except queue.Empty:
             # Queue is empty; continue the loop
             continue
@@ -141,19 +94,16 @@ def handle_new_redditor(created_redditors_queue, threads, stop_event, chat_ids,
             traceback.print_exc()
 
 
-def handle_removed_redditor(removed_redditors_queue, threads, stop_event):
+def handle_removed_redditor(removed_redditors_queue, scheduler, watcher, stop_event):
     while not stop_event.is_set():
         try:
             redditor = removed_redditors_queue.get(timeout=10)
-            for thread in threads:
-                # print(thread)
-                if thread["name"].strip() == redditor.strip():
-                    print(f"{redditor} thread ending")
-                    thread["exit_event"].set()
-                    for inner_thread in thread["threads"]:
-                        if inner_thread.is_alive():
-                            inner_thread.join()
-                            print(f"{redditor} thread got ended")
+            if redditor is None:
+                break
+            scheduler.remove(redditor)
+            if watcher:
+                watcher.remove(redditor)
+            seen.forget(redditor.strip())
 
         except queue.Empty:
             # Queue is empty; continue the loop
@@ -163,62 +113,100 @@ def handle_removed_redditor(removed_redditors_queue, threads, stop_event):
             traceback.print_exc()
 
 
+def account_report(died, revived):
+    lines = []
+    if died:
+        names = ", ".join(redditor[0] for redditor in died)
+        lines.append(f"⚰️suspended or deleted, stopped watching: {names}")
+    if revived:
+        names = ", ".join(redditor[0] for redditor in revived)
+        lines.append(f"🧟back again, watching: {names}")
+    return "\n".join(lines)
+
+
+def refresh_subscriptions():
+    # users added to the users table since the last refresh get a '*'
+    # subscription; /subscribe and /unsubscribe update the index directly
+    seed_subscriptions_db()
+    load_subscriptions_db()
+
+
 def main():
+    setup_logging()
+    migrate_db()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, METRICS_PORT)
     created_redditor_queue = queue.Queue()
     removed_redditors_queue = queue.Queue()
     signal.signal(signal.SIGINT, handle_shutdown_signal)
     signal.signal(signal.SIGTERM, handle_shutdown_signal)
 
     reddit = auth()
-    threads = []
-    redditors = list_redditors_db()
-    chat_ids = get_chat_ids()
+    load_watchlist_db()
+    seen.load()
+    archive.start()
+    load_rules_db()
+    refresh_subscriptions()
+    resolver.load()
+    redditors = [
+        redditor
+        for redditor in list_redditors_db() or []
+        if not resolver.is_dead(redditor[0])
+    ]
+    # anything left pending by the last run goes out as soon as this starts
+    outbox = Outbox()
+    outbox.start()
+    pipeline = AlertPipeline(outbox)
+    scheduler = PollScheduler(reddit, pipeline, STOP_EVENT)
+    watcher = None
+    if FETCH_MODE == "subreddit":
+        watcher = SubredditWatcher(reddit, pipeline, STOP_EVENT, scheduler)
     non_redditor_threads = []
+    feed_sources.append(scheduler.snapshot)
 
-    send_message(
-        chat_ids=chat_ids,
-        message="Starting Reddit-Bot V 1.0 🎇 New Commands:\n/list\n/add <redditor> <rating>\n/remove <redditor>\n/mute <redditor> <days>\n/unmute <redditor>\n/giverockets <redditor> <amount(can be negative)>",
-    )
+    def accounts_changed(died, revived):
+        for redditor in died:
+            scheduler.remove(redditor[0])
+            if watcher:
+                watcher.remove(redditor[0])
+        watch_redditors(revived, scheduler, watcher)
+        send_message(chat_ids=get_chat_ids(), message=account_report(died, revived))
 
-    try:
-        for redditor in redditors:
-            thread_exit_event = threading.Event()
-            thread_submission = threading.Thread(
-                target=observe_submission_loop,
-                args=(reddit, redditor, chat_ids, STOP_EVENT, thread_exit_event),
-            )
-            thread_submission.daemon = True
-            thread_submission.name = redditor[0]
+    sweeper = AccountSweeper(reddit, accounts_changed, STOP_EVENT)
 
-            thread_submission.start()
+    send_message(chat_ids=get_chat_ids(), message=STARTUP_MESSAGE)
 
-            thread_comment = threading.Thread(
-                target=observe_comments_loop,
-                args=(reddit, redditor, chat_ids, STOP_EVENT, thread_exit_event),
+    try:
+        watch_redditors(redditors, scheduler, watcher)
+        pipeline.start()
+        scheduler.start()
+        if watcher:
+            watcher.start()
+        sweeper.start()
+
+        webhook = None
+        if TELEGRAM_MODE == "webhook":
+            webhook = WebhookServer(
+                reddit, created_redditor_queue, removed_redditors_queue
             )
-            thread_comment.daemon = True
-            thread_comment.name = redditor[0]
-
-            thread_comment.start()
-            threads.append(
-                {
-                    "name": redditor[0],
-                    "threads": [thread_submission, thread_comment],
-                    "exit_event": thread_exit_event,
-                }
+            webhook.start()
+        else:
+            telegram_update_handler_thread = threading.Thread(
+                target=handle_update_loop,
+                args=(
+                    STOP_EVENT,
+                    reddit,
+                    created_redditor_queue,
+                    removed_redditors_queue,
+                ),
             )
-
-        telegram_update_handler_thread = threading.Thread(
-            target=handle_update_loop,
-            args=(STOP_EVENT, reddit, created_redditor_queue, removed_redditors_queue),
-        )
-        telegram_update_handler_thread.daemon = True
-        non_redditor_threads.append(telegram_update_handler_thread)
-        telegram_update_handler_thread.start()
+            telegram_update_handler_thread.daemon = True
+            non_redditor_threads.append(telegram_update_handler_thread)
+            telegram_update_handler_thread.start()
 
         handle_new_redditor_thread = threading.Thread(
             target=handle_new_redditor,
-            args=(created_redditor_queue, threads, STOP_EVENT, chat_ids, reddit),
+            args=(created_redditor_queue, scheduler, watcher, STOP_EVENT),
         )
         handle_new_redditor_thread.daemon = True
         non_redditor_threads.append(handle_new_redditor_thread)
@@ -226,42 +214,67 @@ def main():
 
         handle_removed_redditor_thread = threading.Thread(
             target=handle_removed_redditor,
-            args=(removed_redditors_queue, threads, STOP_EVENT),
+            args=(removed_redditors_queue, scheduler, watcher, STOP_EVENT),
         )
         handle_removed_redditor_thread.daemon = True
         non_redditor_threads.append(handle_removed_redditor_thread)
         handle_removed_redditor_thread.start()
 
         sent_message = False
+        last_refresh = time.time()
 
         while not STOP_EVENT.is_set():
 
             if time.localtime().tm_hour == 22 and sent_message == False:
                 print(
-                    send_message(chat_ids=chat_ids, message="🕒Still running hihi🏃‍♂️‍➡️")
+                    send_message(
+                        chat_ids=get_chat_ids(), message="🕒Still running hihi🏃‍♂️‍➡️"
+                    )
                 )
                 sent_message = True
 
+            if time.time() - last_refresh > WATCHLIST_REFRESH_INTERVAL:
+                refresh_subscriptions()
+                last_refresh = time.time()
+
             if time.localtime().tm_hour != 22:
                 sent_message = False
 
-            time.sleep(0.1)  # Reduce CPU usage
+            STOP_EVENT.wait(1)
 
         print("joining threads")
-        # Signal all threads to stop
+        # everything below shares one SHUTDOWN_TIMEOUT
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+
+        def left():
+            return max(0, deadline - time.monotonic())
+
+        # pollers waiting out a rate limit give up now
+        governor.stop()
+        if webhook:
+            webhook.stop()
+        # wake the queue handlers now rather than at their next timeout
+        created_redditor_queue.put(None)
+        removed_redditors_queue.put(None)
+        scheduler.join(left())
+        if watcher:
+            watcher.join(left())
+        # nothing submits alerts any more: queued ones go to the outbox now,
+        # before waiting on slower threads, and are sent on the next start if
+        # Telegram does not take them before the deadline
+        pipeline.close(timeout=left())
+        # the long-poll thread can sit in getUpdates for its whole timeout
         for thread in non_redditor_threads:
-            thread.join()
+            thread.join(left())
             if thread.is_alive():
                 print(f"Thread {thread.name} did not terminate.")
-
-        for thread in threads:
-            for inner_thread in thread["threads"]:
-                inner_thread.join()
-                if inner_thread.is_alive():
-                    print(f"Thread {thread.name} did not terminate.")
         print("threads joined")
+        archive.close()
+        checkpoint_offset(force=True)
+        outbox.close(timeout=left())
 
-        send_message("shutting down⛔", chat_ids)
+        send_message("shutting down⛔", get_chat_ids())
+        get_dispatcher().close(timeout=left())
     except Exception as e:
         print(f"Exception in main loop: {e}")
 
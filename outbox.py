@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+
+from delivery import chat_key, get_dispatcher
+from utils import metrics
+from utils.db import (
+    append_outbox_db,
+    count_outbox_db,
+    digest_message_db,
+    due_outbox_chats_db,
+    init_outbox_db,
+    mark_outbox_db,
+    pending_outbox_db,
+    prune_outbox_db,
+    retry_outbox_db,
+)
+from utils.log import log_event
+from utils.settings import (
+    OUTBOX_BACKOFF,
+    OUTBOX_BATCH,
+    OUTBOX_MAX_BACKOFF,
+    OUTBOX_POLL_INTERVAL,
+    OUTBOX_RETENTION,
+)
+
+log = logging.getLogger("outbox")
+
+# Telegram will never accept these (chat gone, bot blocked), retrying is moot
+PERMANENT_ERRORS = (400, 403)
+
+outbox_pending = metrics.Gauge(
+    "redditwatch_outbox_pending", "Alert messages in the outbox waiting to be sent"
+)
+outbox_results = metrics.Counter(
+    "redditwatch_outbox_total", "Outbox rows closed or retried", ("result",)
+)
+
+
+class Outbox:
+    """Durable queue of formatted alerts in the outbox table.
+
+    Every message is written once per chat before it is sent, so an alert
+    survives a Telegram outage or a restart. A worker thread hands each chat
+    with due rows to the dispatcher, which sends that chat's rows oldest
+    first and stops at the first failure: the row backs off exponentially
+    and the rows behind it wait, keeping each chat in order. Rows still
+    pending at startup are sent like any other.
+
+    Rows of a digest (see pipeline.py) after the first are edits of the
+    message the first one produced. When several edits of one digest are
+    waiting only the newest is sent.
+    """
+
+    def __init__(self, dispatcher=None):
+        self.dispatcher = dispatcher or get_dispatcher()
+        init_outbox_db()
+        self._pending = count_outbox_db()
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        outbox_pending.set(self._pending)
+
+    def append(self, entries):
+        """Store (text, digest, method, chat_ids) ``entries`` in one transaction"""
+        now = time.time()
+        rows = [
+            (chat_key(id), text, now, method, digest)
+            for text, digest, method, chat_ids in entries
+            for id in chat_ids
+        ]
+        if not rows:
+            return True
+        if not append_outbox_db(rows):
+            return False
+        with self._condition:
+            self._pending += len(rows)
+            outbox_pending.set(self._pending)
+            self._condition.notify()
+        return True
+
+    def pending(self):
+        return self._pending
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work, name="outbox")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, timeout=None):
+        """Stop sending, giving in-flight chats up to ``timeout`` seconds.
+
+        Rows that were not sent stay pending for the next start; returns
+        how many there are.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            while self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        if self._thread:
+            self._thread.join()
+        if self._pending:
+            log_event(log, logging.INFO, "outbox_left_pending", rows=self._pending)
+        return self._pending
+
+    def _work(self):
+        last_prune = 0
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                busy = set(self._in_flight)
+            for chat_id in due_outbox_chats_db(time.time()):
+                if chat_id in busy:
+                    continue
+                with self._condition:
+                    self._in_flight.add(chat_id)
+                self.dispatcher.executor.submit(chat_id, self._deliver, chat_id)
+            if time.time() - last_prune > 60 * 60:
+                prune_outbox_db(time.time() - OUTBOX_RETENTION)
+                last_prune = time.time()
+            with self._condition:
+                if not self._stopping:
+                    self._condition.wait(OUTBOX_POLL_INTERVAL)
+
+    def _deliver(self, chat_id):
+        try:
+            rows = pending_outbox_db(chat_id, OUTBOX_BATCH)
+            newest_edit = {
+                digest: id
+                for id, _, _, method, digest in rows
+                if method == "editMessageText"
+            }
+            for id, message, attempts, method, digest in rows:
+                if self._stopping:
+                    return
+                if method == "editMessageText" and newest_edit[digest] != id:
+                    self._close_row(id, "superseded")
+                    continue
+                response = self._send(chat_id, message, method, digest)
+                if response.get("ok"):
+                    result = response.get("result")
+                    message_id = (
+                        result.get("message_id") if isinstance(result, dict) else None
+                    )
+                    self._close_row(id, "sent", message_id)
+                elif response.get("error_code") in PERMANENT_ERRORS:
+                    log_event(
+                        log,
+                        logging.WARNING,
+                        "outbox_undeliverable",
+                        chat_id=chat_id,
+                        error=response.get("description"),
+                    )
+                    self._close_row(id, "failed")
+                else:
+                    delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_BACKOFF * 2**attempts)
+                    retry_outbox_db(id, time.time() + delay)
+                    outbox_results.inc(result="retry")
+                    return
+        finally:
+            with self._condition:
+                self._in_flight.discard(chat_id)
+                self._condition.notify_all()
+
+    def _send(self, chat_id, text, method, digest):
+        if method == "editMessageText":
+            message_id = digest_message_db(chat_id, digest)
+            if message_id is not None:
+                response = (
+                    self.dispatcher.call(
+                        method,
+                        chat_id,
+                        {"chat_id": chat_id, "message_id": message_id, "text": text},
+                    )
+                    or {}
+                )
+                if "not modified" in response.get("description", ""):
+                    return {"ok": True}
+                if response.get("error_code") != 400:
+                    return response
+            # the message to edit never went out or was deleted: send it anew
+        return self.dispatcher.send(text, chat_id) or {}
+
+    def _close_row(self, id, status, message_id=None):
+        # only the first close of a row counts, a replayed send is a no-op
+        if mark_outbox_db(id, status, message_id):
+            outbox_results.inc(result=status)
+            with self._condition:
+                self._pending -= 1
+                outbox_pending.set(self._pending)
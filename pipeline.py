@@ -0,0 +1,354 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from utils import metrics, subscriptions
+from utils.log import log_event
+from utils.settings import (
+    DELIVERY_MAX_PENDING,
+    DIGEST_BYPASS_RATING,
+    DIGEST_WINDOW,
+    OUTBOX_BATCH,
+    PIPELINE_POLICY,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_SPILL_PATH,
+)
+
+log = logging.getLogger("pipeline")
+
+POLICIES = ("coalesce", "drop_lowest", "spill")
+
+# Telegram rejects longer messages; a digest that would outgrow this starts over
+MAX_MESSAGE_LENGTH = 4096
+
+queue_depth = metrics.Gauge(
+    "redditwatch_pipeline_depth", "Alert events waiting to be formatted"
+)
+spill_depth = metrics.Gauge(
+    "redditwatch_pipeline_spilled", "Alert events waiting in the spill file"
+)
+dropped = metrics.Counter(
+    "redditwatch_pipeline_dropped_total",
+    "Alert events dropped because the pipeline was full",
+    ("policy",),
+)
+coalesced = metrics.Counter(
+    "redditwatch_pipeline_coalesced_total",
+    "Alert events folded into a queued alert from the same redditor",
+)
+
+
+class AlertEvent:
+    """What an observer knows about one alert, before any text is built"""
+
+    __slots__ = (
+        "fullname",
+        "redditor",
+        "rating",
+        "kind",
+        "created",
+        "permalink",
+        "subreddit",
+        "text",
+        "url",
+        "thread",
+        "score",
+        "is_submitter",
+        "merged",
+    )
+
+    def __init__(
+        self,
+        fullname,
+        redditor,
+        rating,
+        kind,
+        created,
+        permalink,
+        subreddit,
+        text,
+        url=None,
+        thread=None,
+        score=0,
+        is_submitter=False,
+        merged=0,
+    ):
+        self.fullname = fullname
+        self.redditor = redditor
+        self.rating = rating
+        self.kind = kind
+        self.created = created
+        self.permalink = permalink
+        self.subreddit = subreddit
+        self.text = text
+        self.url = url
+        self.thread = thread
+        self.score = score
+        self.is_submitter = is_submitter
+        self.merged = merged
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+def format_alert(event):
+    """Render the Telegram text for ``event``"""
+    rockets = int(event.rating) * "🚀"
+    if event.kind == "comments":
+        text = f"RATING: {rockets}\n🎇New comment from {event.redditor}:\n{event.text}\nwww.reddit.com{event.permalink}\n🎇"
+    else:
+        text = f"RATING: {rockets}\n🎆New submission from {event.redditor}:\n{event.text}\n{event.url}\n🎆"
+    if event.merged:
+        text += f"\n+{event.merged} more from {event.redditor}"
+    return text
+
+
+def format_digest(events):
+    """Render one message for a burst of alerts in the same thread"""
+    if len(events) == 1:
+        return format_alert(events[0])
+    first = events[0]
+    parts = [
+        f"RATING: {int(first.rating)*'🚀'}\n🎇{len(events)} new from {first.redditor} in one thread:"
+    ]
+    for event in events:
+        if event.kind == "comments":
+            part = f"{event.text}\nwww.reddit.com{event.permalink}"
+        else:
+            part = f"{event.text}\n{event.url}"
+        if event.merged:
+            part += f"\n+{event.merged} more"
+        parts.append(part)
+    return "\n\n".join(parts) + "\n🎇"
+
+
+class Digest:
+    __slots__ = ("id", "started", "events", "chat_ids")
+
+    def __init__(self, event, started, chat_ids):
+        self.id = f"{event.redditor}:{event.thread}:{event.fullname}"
+        self.started = started
+        self.events = [event]
+        self.chat_ids = chat_ids
+
+
+class AlertPipeline:
+    """Bounded hand-off between the observers and the outbox.
+
+    Observers ``submit`` events and never wait on Telegram. One formatting
+    thread renders queued events in batches and appends them to the outbox
+    for the chats subscribed to them (utils/subscriptions.py), holding back
+    while DELIVERY_MAX_PENDING sends are already waiting there. When
+    Telegram is slow the event queue fills up, and once PIPELINE_QUEUE_SIZE
+    events are waiting ``policy`` decides what gives (see utils/settings.py).
+
+    Spilled events, and anything that could not be flushed to the outbox at
+    shutdown, are written to ``spill_path`` and fed back in once the queue
+    has drained, including after a restart.
+
+    Alerts from one redditor in one thread within DIGEST_WINDOW seconds are
+    folded into a digest: the first goes out as usual, the rest become
+    edits of that message listing the whole burst.
+    """
+
+    def __init__(
+        self,
+        outbox,
+        policy=PIPELINE_POLICY,
+        maxsize=PIPELINE_QUEUE_SIZE,
+        spill_path=PIPELINE_SPILL_PATH,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown pipeline policy {policy!r}")
+        self.outbox = outbox
+        self.policy = policy
+        self.maxsize = maxsize
+        self.spill_path = spill_path
+        self._events = deque()
+        self._spilled = self._count_spilled()
+        self._condition = threading.Condition()
+        self._closing = False
+        self._deadline = None
+        self._thread = None
+        self._digests = {}
+        spill_depth.set(self._spilled)
+
+    def submit(self, event):
+        """Queue ``event``; returns False if backpressure dropped it"""
+        with self._condition:
+            if len(self._events) < self.maxsize:
+                self._events.append(event)
+                accepted = True
+            else:
+                accepted = self._overflow(event)
+            queue_depth.set(len(self._events))
+            self._condition.notify()
+        return accepted
+
+    def pending(self):
+        return len(self._events) + self._spilled
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work, name="alert-pipeline")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, timeout=None):
+        """Flush queued events to the outbox for up to ``timeout`` seconds.
+
+        Returns how many events were left over and spilled to disk.
+        """
+        with self._condition:
+            if timeout is not None:
+                self._deadline = time.monotonic() + timeout
+            self._closing = True
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join()
+        with self._condition:
+            left = len(self._events)
+            if left:
+                self._spill(self._events)
+                self._events.clear()
+                queue_depth.set(0)
+                log_event(log, logging.WARNING, "alerts_spilled", events=left)
+        return left
+
+    def _overflow(self, event):
+        if self.policy == "spill":
+            self._spill([event])
+            return True
+        if self.policy == "coalesce":
+            for queued in reversed(self._events):
+                if queued.redditor == event.redditor and queued.kind == event.kind:
+                    queued.merged += 1 + event.merged
+                    coalesced.inc()
+                    return True
+        # drop_lowest, or coalesce with nothing to fold the event into
+        lowest = min(self._events, key=lambda queued: queued.rating)
+        victim = event
+        if event.rating > lowest.rating:
+            self._events.remove(lowest)
+            self._events.append(event)
+            victim = lowest
+        dropped.inc(policy=self.policy)
+        log_event(
+            log,
+            logging.WARNING,
+            "alert_dropped",
+            redditor=victim.redditor,
+            fullname=victim.fullname,
+            policy=self.policy,
+        )
+        return victim is not event
+
+    def _count_spilled(self):
+        if not os.path.exists(self.spill_path):
+            return 0
+        with open(self.spill_path, encoding="utf-8") as file:
+            return sum(1 for _ in file)
+
+    def _spill(self, events):
+        with open(self.spill_path, "a", encoding="utf-8") as file:
+            for event in events:
+                file.write(json.dumps(event.to_dict()) + "\n")
+                self._spilled += 1
+        spill_depth.set(self._spilled)
+
+    def _unspill(self):
+        """Move up to ``maxsize`` spilled events back into the queue"""
+        with open(self.spill_path, encoding="utf-8") as file:
+            lines = file.readlines()
+        batch, rest = lines[: self.maxsize], lines[self.maxsize :]
+        if rest:
+            with open(self.spill_path + ".tmp", "w", encoding="utf-8") as file:
+                file.writelines(rest)
+            os.replace(self.spill_path + ".tmp", self.spill_path)
+        else:
+            os.remove(self.spill_path)
+        for line in batch:
+            try:
+                self._events.append(AlertEvent.from_dict(json.loads(line)))
+            except (ValueError, TypeError):
+                # a line cut short by a crash mid-write
+                logging.error(f"Skipping unreadable spilled alert: {line!r}")
+        self._spilled = len(rest)
+        spill_depth.set(self._spilled)
+
+    def _expired(self):
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if self._closing and (not self._events or self._expired()):
+                    return []
+                if not self._events and self._spilled and not self._closing:
+                    self._unspill()
+                if self._events:
+                    count = min(OUTBOX_BATCH, len(self._events))
+                    batch = [self._events.popleft() for _ in range(count)]
+                    queue_depth.set(len(self._events))
+                    return batch
+                self._condition.wait(1)
+
+    def _render(self, batch):
+        """Turn events into (text, digest, method, chat_ids) outbox entries"""
+        now = time.monotonic()
+        for key in [
+            key
+            for key, digest in self._digests.items()
+            if now - digest.started >= DIGEST_WINDOW
+        ]:
+            del self._digests[key]
+        entries = []
+        for event in batch:
+            chat_ids = subscriptions.chats_for(
+                event.redditor, event.rating, event.subreddit
+            )
+            if not chat_ids:
+                continue
+            if (
+                not DIGEST_WINDOW
+                or event.thread is None
+                or event.rating >= DIGEST_BYPASS_RATING
+            ):
+                entries.append((format_alert(event), None, "sendMessage", chat_ids))
+                continue
+            key = (event.redditor, event.thread)
+            digest = self._digests.get(key)
+            if digest is not None:
+                digest.events.append(event)
+                text = format_digest(digest.events)
+                if len(text) <= MAX_MESSAGE_LENGTH:
+                    # edits go to the chats that got the first message
+                    entries.append(
+                        (text, digest.id, "editMessageText", digest.chat_ids)
+                    )
+                    continue
+            digest = self._digests[key] = Digest(event, now, chat_ids)
+            entries.append((format_alert(event), digest.id, "sendMessage", chat_ids))
+        return entries
+
+    def _work(self):
+        while True:
+            # at shutdown flush regardless of the outbox backlog
+            while self.outbox.pending() >= DELIVERY_MAX_PENDING and not self._closing:
+                time.sleep(0.1)
+            batch = self._next_batch()
+            if not batch:
+                return
+            if not self.outbox.append(self._render(batch)):
+                with self._condition:
+                    self._events.extendleft(reversed(batch))
+                    queue_depth.set(len(self._events))
+                if self._closing:
+                    return
+                time.sleep(1)
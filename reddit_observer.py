@@ -1,77 +1,254 @@
 import praw
 import praw.exceptions
+import prawcore
+from pipeline import AlertEvent
 from utils.config import REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET, REDDIT_USER_AGENT
 from utils.db import is_muted
+from utils import archive, rules, seen
+from utils import metrics
+from utils.log import log_event
+from utils.ratelimit import RedditGovernor
+from utils.settings import POLL_MAX_INTERVAL, REDDIT_MAX_RPM, REDDIT_RESERVE
 import logging
+import threading
 import time
 
+try:
+    import asyncprawcore
+except ImportError:  # only async_main.py needs it
+    asyncprawcore = None
 
-def auth():
+log = logging.getLogger("reddit_observer")
+
+# errors the sync and async clients raise for a rate limit, and for a
+# listing that is gone
+RATE_LIMITED = (prawcore.exceptions.TooManyRequests,)
+GONE = (prawcore.exceptions.NotFound, prawcore.exceptions.Forbidden)
+if asyncprawcore is not None:
+    RATE_LIMITED += (asyncprawcore.exceptions.TooManyRequests,)
+    GONE += (asyncprawcore.exceptions.NotFound, asyncprawcore.exceptions.Forbidden)
+
+# every Reddit request in the process (streams, existence checks, backfills)
+# waits on this before going out
+governor = RedditGovernor(REDDIT_MAX_RPM, REDDIT_RESERVE)
+
+for _name in ("requests", "throttled", "seconds_waited", "remaining", "rate_per_minute"):
+    metrics.Gauge(
+        f"redditwatch_reddit_budget_{_name}",
+        f"Reddit rate-limit governor: {_name.replace('_', ' ')}",
+        function=lambda _name=_name: governor.metrics()[_name] or 0,
+    )
+
+
+class _Building(threading.local):
+    """Context flag set while a listing item is turned into an event"""
+
+    active = False
+
+    def __enter__(self):
+        self.active = True
+
+    def __exit__(self, *exc_info):
+        self.active = False
+
+
+_building = _Building()
+
+# should stay at zero: building an event must never cost a request
+item_fetches = metrics.Counter(
+    "redditwatch_item_fetches_total",
+    "Reddit requests made while building an alert event from a listing item",
+)
+
+
+class _Poller(threading.local):
+    """Poll budget the requests of a scheduler worker thread are charged to"""
+
+    budget = None
+    stop_event = None
+
+
+_poller = _Poller()
+
+
+def charge_polls(budget, stop_event):
+    """Charge every Reddit request this thread sends to ``budget``"""
+    _poller.budget = budget
+    _poller.stop_event = stop_event
+
+
+def charge_poll():
+    """Take a poll budget token if this thread is a poller"""
+    if _poller.budget is not None:
+        _poller.budget.acquire(_poller.stop_event)
+
+
+class GovernedRequestor(prawcore.Requestor):
+    def request(self, *args, **kwargs):
+        if _building.active:
+            item_fetches.inc()
+        # only requests that actually go out take a token: a stream handing
+        # out items it already fetched costs nothing
+        charge_poll()
+        governor.acquire()
+        response = super().request(*args, **kwargs)
+        governor.update(response.status_code, response.headers)
+        return response
+
+
+def auth(credentials=None):
+    """Reddit client for ``credentials`` (see SHARD_CREDENTIALS) or utils/config.py"""
+    credentials = credentials or {
+        "client_id": REDDIT_CLIENT_ID,
+        "client_secret": REDDIT_CLIENT_SECRET,
+        "user_agent": REDDIT_USER_AGENT,
+    }
     reddit = praw.Reddit(
-        client_id=REDDIT_CLIENT_ID,
-        client_secret=REDDIT_CLIENT_SECRET,
-        user_agent=REDDIT_USER_AGENT,
+        client_id=credentials["client_id"],
+        client_secret=credentials["client_secret"],
+        user_agent=credentials["user_agent"],
+        requestor_class=GovernedRequestor,
     )
     return reddit
 
 
+def retry_delay(error, delay):
+    """Seconds to wait before rebuilding a stream that raised ``error``.
+
+    Rate limit errors retry right away: the governor has already paused every
+    caller until Reddit's window resets. A listing that is gone (account
+    suspended or deleted) retries slowly until resolver.py stops polling it.
+    """
+    if isinstance(error, RATE_LIMITED):
+        return 0
+    if isinstance(error, GONE):
+        return POLL_MAX_INTERVAL
+    return delay
+
+
+def item_event(item, kind, redditor):
+    """Copy what the filters and the alert need out of a listing item.
+
+    Only fields the listing JSON already filled in are read, straight from
+    the instance dict, so nothing here can make PRAW fetch the item again.
+    """
+    data = vars(item)
+    subreddit = data.get("subreddit")
+    fullname = data.get("name") or item.fullname
+    return AlertEvent(
+        fullname,
+        redditor[0],
+        int(redditor[1]),
+        kind,
+        data.get("created_utc", 0.0),
+        data.get("permalink", ""),
+        getattr(subreddit, "display_name", subreddit) or "",
+        data.get("body" if kind == "comments" else "title", ""),
+        data.get("url"),
+        thread=data.get("link_id", fullname),
+        score=data.get("score", 0),
+        is_submitter=data.get("is_submitter", False),
+    )
+
+
+def new_event(item, kind, redditor):
+    """Build the event for an item and archive it, or None if seen before"""
+    with _building:
+        event = item_event(item, kind, redditor)
+    if not seen.is_new(redditor[0], kind, event.fullname, event.created):
+        return None
+    data = vars(item)
+    if kind == "comments":
+        archive.record(event, data.get("link_title"), event.text)
+    else:
+        archive.record(event, event.text, data.get("selftext"))
+    return event
+
+
+def wanted(event):
+    """True if ``event`` passes the mute list and the rules"""
+    return not is_muted(event.redditor) and rules.current().allows(
+        event.subreddit, event.score, event.created, event.text, event.is_submitter
+    )
+
+
+def build_event(item, kind, redditor):
+    """Build the alert event for an item, or None if it is filtered out"""
+    event = new_event(item, kind, redditor)
+    if event is not None and wanted(event):
+        return event
+
+
+def comment_event(comment, redditor):
+    return build_event(comment, "comments", redditor)
+
+
+def submission_event(submission, redditor):
+    return build_event(submission, "submissions", redditor)
+
+
+def record_item(redditor, kind, event):
+    """Count an item a stream returned and whether it became an alert"""
+    metrics.items.inc(redditor=redditor[0], kind=kind)
+    metrics.last_item.set(time.time(), redditor=redditor[0], kind=kind)
+    if event:
+        metrics.alerts.inc(redditor=redditor[0], kind=kind)
+    log_event(
+        log,
+        logging.INFO,
+        "item",
+        redditor=redditor[0],
+        kind=kind,
+        alert=bool(event),
+    )
+
+
+def observe_item(item, kind, redditor):
+    """(event, alert) for an item a stream returned.
+
+    ``event`` is None if the item was seen before, ``alert`` is None unless
+    the event passed the filters.
+    """
+    event = new_event(item, kind, redditor)
+    alert = event if event is not None and wanted(event) else None
+    record_item(redditor, kind, alert)
+    return event, alert
+
+
+@metrics.observe_seconds.time(kind="comments")
 def observe_comments(comment_stream, redditor):
-    """Monitor comments for a redditor"""
+    """Poll a redditor's comment stream once; False if it had nothing"""
     try:
         comment = next(comment_stream)
-        print(f"Checked {redditor} comments")
+        metrics.polls.inc(redditor=redditor[0], kind="comments")
+        log_event(log, logging.DEBUG, "poll", redditor=redditor[0], kind="comments")
         if comment is None:
             return False
-        print(f"received comment from {redditor[0]}")
-        if (
-            (comment.subreddit.display_name in {"wallstreetbets", "thetagang"})
-            and not comment.is_submitter
-            and not is_muted(redditor[0])
-            and comment.created > time.time() - (60*60*24)
-        ):
-            return f"RATING: {int(redditor[1])*'🚀'}\n🎇New comment from {redditor[0]}:\n{comment.body}\nwww.reddit.com{comment.permalink}\n🎇"
+        return observe_item(comment, "comments", redditor)
 
     except StopIteration:
         return False
-    except Exception as e:
-        print(f"Error processing comment for {redditor}: {e}")
+    except Exception:
         logging.error(
             f"An error occurre in observe comments for {redditor[0]}", exc_info=True
         )
         raise
 
 
+@metrics.observe_seconds.time(kind="submissions")
 def observe_submissions(submission_stream, redditor):
-    """Monitor submissions for a redditor"""
+    """Poll a redditor's submission stream once; False if it had nothing"""
     try:
         submission = next(submission_stream)
-        print(f"Checked {redditor} submission")
+        metrics.polls.inc(redditor=redditor[0], kind="submissions")
+        log_event(log, logging.DEBUG, "poll", redditor=redditor[0], kind="submissions")
         if submission is None:
             return False
-        print(f"received submission from {redditor[0]}")
-        if (
-            submission.subreddit.display_name in {"wallstreetbets", "thetagang"}
-        ) and not is_muted(redditor[0]) and submission.created > time.time() - (60*60*24):
-            return f"RATING: {int(redditor[1])*'🚀'}\n🎆New submission from {redditor[0]}:\n{submission.title}\n{submission.url}\n🎆"
+        return observe_item(submission, "submissions", redditor)
     except StopIteration:
         return False
-    except Exception as e:
-        print(f"Error processing submission for {redditor}: {e}")
+    except Exception:
         logging.error(
             f"An error occurre in observe submissions for {redditor[0]}", exc_info=True
         )
         raise
-
-
-def check_redditor_exists(reddit, redditor):
-    try:
-        redditor = reddit.redditor(redditor)
-        redditor.fullname
-        return True
-    except praw.exceptions.RedditAPIException as e:
-        # If RedditAPIException is raised, the redditor doesn't exist
-        print(f"Error: {e}")
-        return False  # Return False if the redditor does not exist
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        return False
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+
+import prawcore
+
+from utils.db import (
+    init_accounts_db,
+    list_redditors_db,
+    load_accounts_db,
+    save_accounts_db,
+)
+from utils.log import log_event
+from utils.settings import (
+    RESOLVER_NEGATIVE_TTL,
+    RESOLVER_SWEEP_INTERVAL,
+    RESOLVER_TTL,
+)
+
+log = logging.getLogger("resolver")
+
+# Which redditors still exist. Each account's fullname (t2_...) is looked up
+# once with /user/<name>/about and kept in the accounts table; from then on
+# the sweep checks up to 100 accounts per request against
+# /api/user_data_by_account_ids, which leaves out suspended and deleted ones.
+# Answers are cached for RESOLVER_TTL seconds if the account exists and for
+# RESOLVER_NEGATIVE_TTL if it does not.
+
+
+class Account:
+    __slots__ = ("name", "fullname", "alive", "checked")
+
+    def __init__(self, name, fullname, alive, checked):
+        self.name = name
+        self.fullname = fullname
+        self.alive = alive
+        self.checked = checked
+
+
+_accounts = {}
+_lock = threading.Lock()
+
+
+def _key(name):
+    return name.strip().lower()
+
+
+def load():
+    init_accounts_db()
+    rows = load_accounts_db()
+    with _lock:
+        _accounts.clear()
+        for name, fullname, alive, checked in rows:
+            _accounts[_key(name)] = Account(name, fullname, bool(alive), checked)
+
+
+def _store(accounts):
+    with _lock:
+        for account in accounts:
+            _accounts[_key(account.name)] = account
+    save_accounts_db(
+        [
+            (_key(account.name), account.fullname, int(account.alive), account.checked)
+            for account in accounts
+        ]
+    )
+
+
+def is_dead(name):
+    """True if the last check found ``name`` suspended or deleted"""
+    account = _accounts.get(_key(name))
+    return account is not None and not account.alive
+
+
+def fetch_account(reddit, name):
+    """Look ``name`` up with one request.
+
+    Raises on errors that say nothing about the account (network, 5xx,
+    rate limits) so callers do not mistake them for a missing account.
+    """
+    redditor = reddit.redditor(name.strip())
+    try:
+        if getattr(redditor, "is_suspended", False):
+            return Account(name, None, False, time.time())
+        return Account(name, redditor.fullname, True, time.time())
+    except prawcore.exceptions.NotFound:
+        return Account(name, None, False, time.time())
+
+
+def check(reddit, name):
+    """True if ``name`` exists, False if not, None if Reddit could not say"""
+    account = _accounts.get(_key(name))
+    if account is not None:
+        ttl = RESOLVER_TTL if account.alive else RESOLVER_NEGATIVE_TTL
+        if time.time() - account.checked < ttl:
+            return account.alive
+    try:
+        account = fetch_account(reddit, name)
+    except Exception as e:
+        log_event(log, logging.WARNING, "lookup_failed", redditor=name, error=str(e))
+        return None
+    _store([account])
+    return account.alive
+
+
+def sweep(reddit, names):
+    """Recheck ``names``; returns the (died, revived) names since last time"""
+    now = time.time()
+    with _lock:
+        known = {name: _accounts.get(_key(name)) for name in names}
+    fullnames = [
+        account.fullname for account in known.values() if account and account.fullname
+    ]
+    found = {
+        partial.fullname: partial
+        for partial in reddit.redditors.partial_redditors(fullnames)
+    }
+    checked = []
+    died = []
+    revived = []
+    lookups = 0
+    for name, account in known.items():
+        if account is not None and account.fullname:
+            partial = found.get(account.fullname)
+            alive = partial is not None and not getattr(
+                partial, "is_suspended", False
+            )
+            new = Account(name, account.fullname, alive, now)
+        else:
+            # never resolved, or suspended (the about page hides the id)
+            lookups += 1
+            try:
+                new = fetch_account(reddit, name)
+            except Exception as e:
+                log_event(
+                    log, logging.WARNING, "lookup_failed", redditor=name, error=str(e)
+                )
+                continue
+        was_alive = account is None or account.alive
+        if was_alive and not new.alive:
+            died.append(name)
+        elif not was_alive and new.alive:
+            revived.append(name)
+        checked.append(new)
+    _store(checked)
+    log_event(
+        log,
+        logging.INFO,
+        "accounts_swept",
+        accounts=len(checked),
+        requests=(len(fullnames) + 99) // 100 + lookups,
+        died=len(died),
+        revived=len(revived),
+    )
+    return died, revived
+
+
+class AccountSweeper:
+    """Sweeps the watchlist every RESOLVER_SWEEP_INTERVAL seconds.
+
+    ``on_change(died, revived)`` gets the redditor rows that were found
+    suspended or deleted, or came back, since the previous sweep.
+    """
+
+    def __init__(self, reddit, on_change, stop_event):
+        self.reddit = reddit
+        self.on_change = on_change
+        self.stop_event = stop_event
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work, name="account-sweeper")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def sweep_once(self):
+        redditors = list_redditors_db()
+        if redditors is None:
+            return
+        rows = {redditor[0]: redditor for redditor in redditors}
+        try:
+            died, revived = sweep(self.reddit, list(rows))
+        except Exception:
+            # a failed batch says nothing about the accounts in it
+            logging.error("Account sweep failed", exc_info=True)
+            return
+        if died or revived:
+            self.on_change(
+                [rows[name] for name in died], [rows[name] for name in revived]
+            )
+
+    def _work(self):
+        while not self.stop_event.is_set():
+            self.sweep_once()
+            self.stop_event.wait(RESOLVER_SWEEP_INTERVAL)
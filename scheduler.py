@@ -0,0 +1,330 @@
+import gc
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from reddit_observer import (
+    charge_polls,
+    observe_comments,
+    observe_submissions,
+    retry_delay,
+)
+from utils import metrics, seen, watchlist
+from utils.log import log_event
+from utils.ratelimit import TokenBucket
+from utils.settings import (
+    POLL_BUDGET_RPM,
+    POLL_GAP_FRACTION,
+    POLL_JITTER,
+    POLL_MAX_INTERVAL,
+    POLL_MIN_INTERVAL,
+    POLLER_WORKERS,
+    RETRY_DELAY,
+    STREAM_INIT_CONCURRENCY,
+)
+
+KINDS = ("submissions", "comments")
+
+log = logging.getLogger("scheduler")
+
+OBSERVERS = {
+    "submissions": observe_submissions,
+    "comments": observe_comments,
+}
+
+unarmed = metrics.Gauge(
+    "redditwatch_feeds_unarmed", "Feeds whose stream has not completed a first poll"
+)
+
+
+def feed_key(name, kind):
+    return name.strip().lower(), kind
+
+
+class Feed:
+    """One polled listing: a (redditor, kind) pair and its PRAW stream."""
+
+    __slots__ = (
+        "redditor",
+        "kind",
+        "stream",
+        "active",
+        "last_item",
+        "avg_gap",
+        "due",
+    )
+
+    def __init__(self, redditor, kind):
+        self.redditor = redditor
+        self.kind = kind
+        self.stream = None
+        self.active = True
+        self.last_item = seen.watermark(redditor[0], kind) or time.time()
+        self.avg_gap = 0.0
+        self.due = None
+
+    @property
+    def key(self):
+        return feed_key(self.redditor[0], self.kind)
+
+    def floor(self):
+        """Shortest interval for this redditor, tighter for higher ratings"""
+        entry = watchlist.get(self.redditor[0])
+        rating = entry.rating if entry else int(self.redditor[1])
+        rating = min(max(rating, 1), 10)
+        return POLL_MIN_INTERVAL * (2 - rating / 10)
+
+    def record_item(self, created):
+        """Account for a new item posted at ``created``"""
+        if created <= self.last_item:
+            return
+        gap = created - self.last_item
+        self.avg_gap = gap if not self.avg_gap else 0.7 * self.avg_gap + 0.3 * gap
+        self.last_item = created
+
+    def interval(self, now):
+        # back off as the silence since the last item grows, but not past the
+        # account's usual gap unless it has been quiet for twice that long
+        idle = now - self.last_item
+        gap = idle
+        if self.avg_gap and idle < 2 * self.avg_gap:
+            gap = min(idle, self.avg_gap)
+        return min(POLL_MAX_INTERVAL, max(self.floor(), gap * POLL_GAP_FRACTION))
+
+    def build_stream(self, reddit):
+        # no skip_existing: the first batch backfills whatever was posted
+        # since the stored watermark and utils.seen drops everything else
+        seen.register(self.redditor[0], self.kind)
+        listing = getattr(reddit.redditor(self.redditor[0]).stream, self.kind)
+        return listing(pause_after=0)
+
+
+def warm_start(count, now):
+    """First-poll times for ``count`` new feeds, in order.
+
+    The feeds get one slot each, evenly spaced over POLL_MIN_INTERVAL or over
+    as long as POLL_BUDGET_RPM needs to poll all of them once, and a random
+    time within their slot, so a large watchlist does not poll in lockstep.
+    """
+    if not count:
+        return []
+    spacing = max(60 / POLL_BUDGET_RPM, POLL_MIN_INTERVAL / count)
+    return [now + (index + random.random()) * spacing for index in range(count)]
+
+
+class PollScheduler:
+    """Polls every watched redditor from a fixed pool of worker threads.
+
+    Feeds sit in a heap ordered by their next due time. A worker pops the
+    earliest due feed, polls it once and pushes it back with a new due time,
+    so the thread count does not depend on the size of the watchlist.
+
+    Feeds are registered by normalized username, so adding a redditor that
+    is already watched only updates its rating. Removing one is a dict pop:
+    the feed is flagged inactive, its stream released at once, and the heap
+    entry dropped when it reaches the top (or when stale entries pile up).
+    ``snapshot`` lists the live feeds.
+
+    Each feed's interval follows its recent activity (see Feed.interval) and
+    the requests the workers send share a POLL_BUDGET_RPM token bucket.
+
+    New feeds are not all due at once: ``add_many`` spreads their first polls
+    over one interval (see ``warm_start``) and only STREAM_INIT_CONCURRENCY
+    workers run a first poll, which backfills a whole listing, at a time.
+    Once every feed has polled once the time it took is logged as
+    ``fully_armed``.
+    """
+
+    def __init__(self, reddit, pipeline, stop_event, workers=POLLER_WORKERS):
+        self.reddit = reddit
+        self.pipeline = pipeline
+        self.stop_event = stop_event
+        self.workers = workers
+        self._heap = []
+        self._feeds = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._threads = []
+        self.budget = TokenBucket(POLL_BUDGET_RPM / 60, capacity=workers)
+        self._init_slots = threading.BoundedSemaphore(STREAM_INIT_CONCURRENCY)
+        self._unarmed = set()
+        self._arming_since = None
+        self.armed_after = None
+
+    def add(self, redditor):
+        self.add_many([redditor])
+
+    def add_many(self, redditors):
+        """Schedule redditors, highest rated first, with staggered first polls"""
+        redditors = sorted(redditors, key=lambda redditor: -int(redditor[1]))
+        with self._condition:
+            new = []
+            for redditor in redditors:
+                for kind in KINDS:
+                    feed = self._feeds.get(feed_key(redditor[0], kind))
+                    if feed:
+                        # already watched: keep the stream, take the new rating
+                        feed.redditor = (feed.redditor[0], redditor[1])
+                    else:
+                        new.append(Feed(redditor, kind))
+            if new and not self._unarmed:
+                self._arming_since = time.time()
+            for feed, first_poll in zip(new, warm_start(len(new), time.time())):
+                self._feeds[feed.key] = feed
+                self._unarmed.add(feed.key)
+                self._push(feed, first_poll)
+            unarmed.set(len(self._unarmed))
+            self._condition.notify_all()
+        for redditor in redditors:
+            log_event(log, logging.INFO, "scheduled", redditor=redditor[0])
+
+    def remove(self, name):
+        with self._condition:
+            for kind in KINDS:
+                feed = self._feeds.pop(feed_key(name, kind), None)
+                if feed:
+                    feed.active = False
+                    feed.stream = None
+                    self._armed(feed)
+            if len(self._heap) > 2 * len(self._feeds) + 64:
+                self._heap = [entry for entry in self._heap if entry[2].active]
+                heapq.heapify(self._heap)
+        log_event(log, logging.INFO, "unscheduled", redditor=name)
+
+    def watching(self, name):
+        with self._condition:
+            return feed_key(name, KINDS[0]) in self._feeds
+
+    def snapshot(self):
+        """(redditor, kind, armed, seconds until next poll) for each live feed"""
+        now = time.time()
+        with self._condition:
+            feeds = list(self._feeds.values())
+            unarmed_keys = set(self._unarmed)
+        return sorted(
+            (
+                feed.redditor[0],
+                feed.kind,
+                feed.key not in unarmed_keys,
+                max(0.0, feed.due - now) if feed.due else 0.0,
+            )
+            for feed in feeds
+        )
+
+    def _push(self, feed, due):
+        # caller holds self._condition
+        feed.due = due
+        heapq.heappush(self._heap, (due, next(self._counter), feed))
+
+    def _armed(self, feed):
+        # caller holds self._condition
+        key = feed.key
+        if key not in self._unarmed:
+            return
+        self._unarmed.discard(key)
+        unarmed.set(len(self._unarmed))
+        if not self._unarmed:
+            self.armed_after = time.time() - self._arming_since
+            log_event(
+                log,
+                logging.INFO,
+                "fully_armed",
+                feeds=len(self._feeds),
+                seconds=round(self.armed_after, 1),
+            )
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"poller-{index}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self, timeout=None):
+        # wake idle workers so they see the stop event now
+        with self._condition:
+            self._condition.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                print(f"Thread {thread.name} did not terminate.")
+
+    def _next_feed(self):
+        with self._condition:
+            while not self.stop_event.is_set():
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, _, feed = self._heap[0]
+                if not feed.active:
+                    heapq.heappop(self._heap)
+                    continue
+                delay = due - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                return feed
+        return None
+
+    def _reschedule(self, feed, delay):
+        delay *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        with self._condition:
+            if feed.active:
+                self._push(feed, time.time() + delay)
+                self._condition.notify()
+
+    def _work(self):
+        charge_polls(self.budget, self.stop_event)
+        while True:
+            feed = self._next_feed()
+            if feed is None:
+                return
+            first_poll = feed.stream is None
+            if first_poll and not self._init_slots.acquire(blocking=False):
+                # enough streams are backfilling, come back when one is done
+                self._reschedule(feed, 1)
+                continue
+            try:
+                self._reschedule(feed, self._poll(feed))
+            finally:
+                if first_poll:
+                    self._init_slots.release()
+
+    def _poll(self, feed):
+        try:
+            if feed.stream is None:
+                log_event(
+                    log,
+                    logging.INFO,
+                    "stream_started",
+                    redditor=feed.redditor[0],
+                    kind=feed.kind,
+                )
+                feed.stream = feed.build_stream(self.reddit)
+            result = OBSERVERS[feed.kind](feed.stream, feed.redditor)
+            with self._condition:
+                self._armed(feed)
+            if result is False:
+                return feed.interval(time.time())
+            event, alert = result
+            if alert:
+                self.pipeline.submit(alert)
+            if event:
+                feed.record_item(event.created)
+            # the stream handed us an item: poll again right away, more may
+            # be buffered behind it
+            return 0
+        except Exception as e:
+            metrics.reddit_errors.inc(kind=feed.kind)
+            logging.error(
+                f"An error occurred in {feed.kind} stream for {feed.redditor[0]}",
+                exc_info=True,
+            )
+            feed.stream = None
+            gc.collect()
+            return retry_delay(e, RETRY_DELAY)
@@ -0,0 +1,369 @@
+"""Sharded runtime: one coordinator process plus a worker per Reddit app.
+
+The coordinator owns Telegram (updates, commands, the alert pipeline and
+delivery). Each worker polls the redditors its shard owns on a consistent
+hash ring, with its own entry from SHARD_CREDENTIALS, and sends alert events
+back over a multiprocessing queue. /add and /remove only message the shard
+that owns the redditor, so scaling out is adding a credential and
+restarting. Workers always use per-user streams.
+"""
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import traceback
+
+from delivery import get_dispatcher
+from main import (
+    STOP_EVENT,
+    account_report,
+    handle_shutdown_signal,
+    handle_update_loop,
+    refresh_subscriptions,
+)
+from outbox import Outbox
+from pipeline import AlertEvent, AlertPipeline
+import resolver
+from resolver import AccountSweeper
+from reddit_observer import auth, governor
+from scheduler import PollScheduler
+import telegram
+from telegram import STARTUP_MESSAGE, checkpoint_offset, send_message
+from utils import archive, seen
+from utils.db import (
+    get_chat_ids,
+    list_redditors_db,
+    load_rules_db,
+    load_watchlist_db,
+    migrate_db,
+)
+from utils.hashring import HashRing
+from utils.log import log_event, setup_logging
+from utils.metrics import start_metrics_server
+from utils.settings import (
+    METRICS_HOST,
+    METRICS_PORT,
+    RETRY_DELAY,
+    SHARD_CREDENTIALS,
+    SHUTDOWN_TIMEOUT,
+    TELEGRAM_MODE,
+    WATCHLIST_REFRESH_INTERVAL,
+)
+from webhook import WebhookServer
+
+log = logging.getLogger("shards")
+
+# commands that change state the workers keep a copy of
+RELOAD_COMMANDS = {"/mute", "/unmute", "/giverockets", "/addrule", "/removerule"}
+
+
+def shard_name(index):
+    return f"shard-{index}"
+
+
+def build_ring(count):
+    return HashRing(shard_name(index) for index in range(count))
+
+
+def redditor_key(name):
+    return name.strip().lower()
+
+
+class QueueSink:
+    """Stands in for AlertPipeline in a worker: ships events to the coordinator"""
+
+    def __init__(self, events):
+        self.events = events
+
+    def submit(self, event):
+        self.events.put(event.to_dict())
+        return True
+
+
+def run_worker(index, count, credentials, commands, events, stop_event):
+    """Worker process: polls the redditors shard ``index`` owns"""
+    # Ctrl-C reaches the whole process group; the coordinator decides when
+    # workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging()
+    name = shard_name(index)
+    ring = build_ring(count)
+    reddit = auth(credentials)
+    load_watchlist_db()
+    seen.load()
+    archive.start()
+    load_rules_db()
+    resolver.load()
+    scheduler = PollScheduler(reddit, QueueSink(events), stop_event)
+    watched = set()
+
+    def add(redditors):
+        redditors = [
+            redditor
+            for redditor in redditors
+            if redditor_key(redditor[0]) not in watched
+        ]
+        watched.update(redditor_key(redditor[0]) for redditor in redditors)
+        scheduler.add_many(redditors)
+
+    add(
+        [
+            redditor
+            for redditor in list_redditors_db() or []
+            if ring.node_for(redditor_key(redditor[0])) == name
+            and not resolver.is_dead(redditor[0])
+        ]
+    )
+    scheduler.start()
+    log_event(log, logging.INFO, "shard_started", shard=name, redditors=len(watched))
+
+    while not stop_event.is_set():
+        try:
+            command, argument = commands.get(timeout=1)
+        except queue.Empty:
+            continue
+        try:
+            if command == "add":
+                # the coordinator wrote the row, pick up its rating
+                load_watchlist_db()
+                add([argument])
+            elif command == "remove":
+                watched.discard(redditor_key(argument))
+                scheduler.remove(argument)
+                seen.forget(argument.strip())
+            elif command == "reload":
+                load_watchlist_db()
+                load_rules_db()
+        except Exception as e:
+            print(f"Error in {name} handling {command}: {e}")
+            traceback.print_exc()
+    governor.stop()
+    scheduler.join()
+    archive.close()
+
+
+class Shard:
+    __slots__ = ("index", "credentials", "commands", "process", "started")
+
+    def __init__(self, index, credentials, context):
+        self.index = index
+        self.credentials = credentials
+        self.commands = context.Queue()
+        self.process = None
+        self.started = 0.0
+
+    def start(self, context, count, events, stop_event):
+        self.process = context.Process(
+            target=run_worker,
+            args=(
+                self.index,
+                count,
+                self.credentials,
+                self.commands,
+                events,
+                stop_event,
+            ),
+            name=shard_name(self.index),
+            daemon=True,
+        )
+        self.process.start()
+        self.started = time.time()
+
+
+def route_new_redditors(created_redditors_queue, shards, ring, stop_event):
+    while not stop_event.is_set():
+        try:
+            redditor = created_redditors_queue.get(timeout=10)
+        except queue.Empty:
+            continue
+        if redditor is None:
+            break
+        shard = shards[ring.node_for(redditor_key(redditor[0]))]
+        shard.commands.put(("add", redditor))
+
+
+def route_removed_redditors(removed_redditors_queue, shards, ring, stop_event):
+    while not stop_event.is_set():
+        try:
+            name = removed_redditors_queue.get(timeout=10)
+        except queue.Empty:
+            continue
+        if name is None:
+            break
+        shard = shards[ring.node_for(redditor_key(name))]
+        shard.commands.put(("remove", name))
+
+
+def forward_events(events, pipeline, stop_event):
+    while not stop_event.is_set():
+        try:
+            data = events.get(timeout=1)
+        except queue.Empty:
+            continue
+        pipeline.submit(AlertEvent.from_dict(data))
+
+
+def supervise(shards, context, events, stop_event):
+    """Restart workers that died, at most once per RETRY_DELAY each"""
+    for shard in shards.values():
+        if shard.process.is_alive() or time.time() - shard.started < RETRY_DELAY:
+            continue
+        log_event(
+            log,
+            logging.ERROR,
+            "shard_died",
+            shard=shard_name(shard.index),
+            exitcode=shard.process.exitcode,
+        )
+        shard.start(context, len(shards), events, stop_event)
+
+
+def main():
+    if not SHARD_CREDENTIALS:
+        raise SystemExit("SHARD_CREDENTIALS is empty, run main.py instead")
+    setup_logging()
+    # workers expect the current schema, so migrate before starting them
+    migrate_db()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, METRICS_PORT)
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+    created_redditors_queue = queue.Queue()
+    removed_redditors_queue = queue.Queue()
+
+    # the coordinator's own client only answers /add existence checks
+    reddit = auth()
+    load_watchlist_db()
+    load_rules_db()
+    refresh_subscriptions()
+    # /search reads the archive the workers write
+    archive.start()
+    outbox = Outbox()
+    outbox.start()
+    pipeline = AlertPipeline(outbox)
+    pipeline.start()
+
+    # spawn, not fork: the coordinator already runs threads
+    context = multiprocessing.get_context("spawn")
+    events = context.Queue()
+    worker_stop = context.Event()
+    ring = build_ring(len(SHARD_CREDENTIALS))
+    shards = {
+        shard_name(index): Shard(index, credentials, context)
+        for index, credentials in enumerate(SHARD_CREDENTIALS)
+    }
+    for shard in shards.values():
+        shard.start(context, len(shards), events, worker_stop)
+
+    def reload_workers(name, args):
+        if name in RELOAD_COMMANDS:
+            for shard in shards.values():
+                shard.commands.put(("reload", None))
+
+    telegram.command_listeners.append(reload_workers)
+
+    def accounts_changed(died, revived):
+        for redditor in died:
+            shards[ring.node_for(redditor_key(redditor[0]))].commands.put(
+                ("remove", redditor[0])
+            )
+        for redditor in revived:
+            shards[ring.node_for(redditor_key(redditor[0]))].commands.put(
+                ("add", redditor)
+            )
+        send_message(chat_ids=get_chat_ids(), message=account_report(died, revived))
+
+    resolver.load()
+    sweeper = AccountSweeper(reddit, accounts_changed, STOP_EVENT)
+    send_message(chat_ids=get_chat_ids(), message=STARTUP_MESSAGE)
+
+    threads = [
+        threading.Thread(
+            target=route_new_redditors,
+            args=(created_redditors_queue, shards, ring, STOP_EVENT),
+        ),
+        threading.Thread(
+            target=route_removed_redditors,
+            args=(removed_redditors_queue, shards, ring, STOP_EVENT),
+        ),
+        threading.Thread(target=forward_events, args=(events, pipeline, STOP_EVENT)),
+    ]
+    webhook = None
+    if TELEGRAM_MODE == "webhook":
+        webhook = WebhookServer(reddit, created_redditors_queue, removed_redditors_queue)
+        webhook.start()
+    else:
+        threads.append(
+            threading.Thread(
+                target=handle_update_loop,
+                args=(
+                    STOP_EVENT,
+                    reddit,
+                    created_redditors_queue,
+                    removed_redditors_queue,
+                ),
+            )
+        )
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    sweeper.start()
+
+    try:
+        sent_message = False
+        last_refresh = time.time()
+        while not STOP_EVENT.is_set():
+            supervise(shards, context, events, worker_stop)
+            if time.localtime().tm_hour == 22 and not sent_message:
+                send_message(
+                    chat_ids=get_chat_ids(), message="🕒Still running hihi🏃‍♂️‍➡️"
+                )
+                sent_message = True
+            if time.localtime().tm_hour != 22:
+                sent_message = False
+            if time.time() - last_refresh > WATCHLIST_REFRESH_INTERVAL:
+                refresh_subscriptions()
+                last_refresh = time.time()
+            STOP_EVENT.wait(1)
+
+        print("stopping shards")
+        if webhook:
+            webhook.stop()
+        created_redditors_queue.put(None)
+        removed_redditors_queue.put(None)
+        worker_stop.set()
+        governor.stop()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for shard in shards.values():
+            shard.process.join(max(0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                print(f"{shard_name(shard.index)} did not stop, terminating")
+                shard.process.terminate()
+        # the router and forwarder threads wake at least once a second or on
+        # their sentinel; the long-poll thread can sit in getUpdates for its
+        # whole timeout, so it is joined after the pipeline flush
+        for thread in threads[:3]:
+            thread.join(max(0, deadline - time.monotonic()))
+        # alerts the workers sent while stopping
+        while True:
+            try:
+                pipeline.submit(AlertEvent.from_dict(events.get_nowait()))
+            except queue.Empty:
+                break
+        pipeline.close(timeout=max(0, deadline - time.monotonic()))
+        for thread in threads[3:]:
+            thread.join(max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                print(f"Thread {thread.name} did not terminate.")
+        checkpoint_offset(force=True)
+        outbox.close(timeout=max(0, deadline - time.monotonic()))
+        send_message("shutting down⛔", get_chat_ids())
+        get_dispatcher().close(timeout=max(0, deadline - time.monotonic()))
+    except Exception as e:
+        print(f"Exception in coordinator loop: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import gc
+import logging
+import threading
+import time
+
+from reddit_observer import (
+    comment_event,
+    record_item,
+    retry_delay,
+    submission_event,
+)
+import resolver
+from utils import metrics
+from utils.log import log_event
+from utils import rules, seen
+from utils.db import list_redditors_db
+from utils.settings import (
+    RETRY_DELAY,
+    SUBREDDIT_POLL_INTERVAL,
+    USER_STREAM_REDDITORS,
+    WATCHLIST_REFRESH_INTERVAL,
+)
+
+log = logging.getLogger("subreddit_observer")
+
+EVENT_BUILDERS = {
+    "submissions": submission_event,
+    "comments": comment_event,
+}
+
+
+class SubredditWatcher:
+    """Streams the watched subreddits once and matches authors locally.
+
+    One request per kind covers every watched redditor, instead of one per
+    redditor. Redditors in USER_STREAM_REDDITORS are left to the per-user
+    streams in PollScheduler. The subreddits are the "allow" rules (see
+    utils/rules.py) and the streams are rebuilt when the rules change.
+    Without allow rules there is nothing to stream, so every redditor is
+    handed to ``fallback``, the PollScheduler, until some are added.
+    """
+
+    def __init__(self, reddit, pipeline, stop_event, fallback=None):
+        self.reddit = reddit
+        self.pipeline = pipeline
+        self.stop_event = stop_event
+        self.fallback = fallback
+        self.watched = {}
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._rules_version = None
+        self._thread = None
+
+    def handles(self, name):
+        """True if ``name`` is matched here rather than polled on its own"""
+        return (
+            bool(rules.subreddits())
+            and name.strip().lower() not in USER_STREAM_REDDITORS
+        )
+
+    def add(self, redditor):
+        for kind in EVENT_BUILDERS:
+            seen.register(redditor[0], kind)
+        with self._lock:
+            self.watched[redditor[0].strip().lower()] = redditor
+        log_event(log, logging.INFO, "matching", redditor=redditor[0])
+
+    def remove(self, name):
+        with self._lock:
+            self.watched.pop(name.strip().lower(), None)
+
+    def refresh(self):
+        redditors = list_redditors_db()
+        if redditors is None:
+            return
+        live = [redditor for redditor in redditors if not resolver.is_dead(redditor[0])]
+        with self._lock:
+            self.watched = {
+                redditor[0].strip().lower(): redditor
+                for redditor in live
+                if self.handles(redditor[0])
+            }
+        if self.fallback is None:
+            return
+        # move redditors between here and the per-user streams as the allow
+        # rules come and go
+        self.fallback.add_many(
+            [
+                redditor
+                for redditor in live
+                if not self.handles(redditor[0])
+                and not self.fallback.watching(redditor[0])
+            ]
+        )
+        for redditor in live:
+            if self.handles(redditor[0]) and self.fallback.watching(redditor[0]):
+                self.fallback.remove(redditor[0])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work, name="subreddit-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _stream(self, kind):
+        stream = self._streams.get(kind)
+        if stream is None:
+            log_event(log, logging.INFO, "stream_started", kind=kind)
+            subreddit = self.reddit.subreddit("+".join(rules.subreddits()))
+            stream = getattr(subreddit.stream, kind)(pause_after=0)
+            self._streams[kind] = stream
+        return stream
+
+    def _work(self):
+        last_refresh = time.time()
+        while not self.stop_event.is_set():
+            if self._rules_version != rules.version():
+                # the allow list decides what to stream and who is matched here
+                self._rules_version = rules.version()
+                self._streams.clear()
+                self.refresh()
+                last_refresh = time.time()
+            for kind in EVENT_BUILDERS:
+                if not rules.subreddits():
+                    break
+                try:
+                    self._drain(kind)
+                except Exception as e:
+                    metrics.reddit_errors.inc(kind=kind)
+                    logging.error(
+                        f"An error occurred in subreddit {kind} stream", exc_info=True
+                    )
+                    self._streams.pop(kind, None)
+                    gc.collect()
+                    self.stop_event.wait(retry_delay(e, RETRY_DELAY))
+            if time.time() - last_refresh > WATCHLIST_REFRESH_INTERVAL:
+                self.refresh()
+                last_refresh = time.time()
+            self.stop_event.wait(SUBREDDIT_POLL_INTERVAL)
+
+    def _drain(self, kind):
+        stream = self._stream(kind)
+        for item in stream:
+            if item is None or self.stop_event.is_set():
+                return
+            author = vars(item).get("author")
+            if author is None:
+                continue
+            redditor = self.watched.get(author.name.lower())
+            if redditor is None:
+                continue
+            event = EVENT_BUILDERS[kind](item, redditor)
+            record_item(redditor, kind, event)
+            if event:
+                self.pipeline.submit(event)
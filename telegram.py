@@ -1,76 +1,313 @@
-from utils.config import TELEGRAM_BOT_TOKEN
 from utils.db import get_offset_db, save_offset_db
 from utils.db import (
     add_redditor_db,
+    add_rule_db,
     list_redditors_db,
     mute_redditor_db,
     remove_redditor_db,
+    remove_rule_db,
+    subscribe_db,
     unmute_redditor_db,
+    unsubscribe_db,
     give_rockets_db,
 )
-from reddit_observer import check_redditor_exists
+from reddit_observer import governor
+from delivery import TELEGRAM_URL, get_dispatcher
+import resolver
+from utils import archive, rules, subscriptions, watchlist
+from utils import metrics
+from utils.executors import KeyedExecutor
+from utils.log import log_event
+from utils.settings import (
+    COMMAND_WORKERS,
+    OFFSET_CHECKPOINT_INTERVAL,
+    TELEGRAM_POLL_TIMEOUT,
+)
+import logging
 import requests
+import threading
+import time
 import traceback
 
+log = logging.getLogger("telegram")
+
+STARTUP_MESSAGE = "Starting Reddit-Bot V 1.0 🎇 New Commands:\n/list\n/add <redditor> <rating>\n/remove <redditor>\n/mute <redditor> <days>\n/unmute <redditor>\n/giverockets <redditor> <amount(can be negative)>\n/ratelimit\n/subscribe <redditor|*> [min rating] [subreddit]\n/unsubscribe <redditor|*>\n/subscriptions\n/rules\n/addrule <kind> <value>\n/removerule <kind> <value>\n/search <words...> [@redditor]\n/feeds"
+
+
+# The last handled update_id lives in memory and is only checkpointed to the
+# offset table every OFFSET_CHECKPOINT_INTERVAL seconds. A stale checkpoint is
+# harmless: Telegram drops every update below the offset we last polled with.
+_offset = None
+_checkpointed_offset = None
+_checkpointed_at = 0.0
+_offset_lock = threading.Lock()
+_updates_session = requests.Session()
+
+
+def get_offset():
+    global _offset, _checkpointed_offset
+    with _offset_lock:
+        if _offset is None:
+            _offset = _checkpointed_offset = get_offset_db() or 0
+        return _offset
 
-def handle_updates(reddit, created_redditor_queue, removed_redditor_queue):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
-    offset = get_offset_db() + 1
+
+def checkpoint_offset(force=False):
+    global _checkpointed_offset, _checkpointed_at
+    with _offset_lock:
+        if _offset is None or _offset == _checkpointed_offset:
+            return
+        if not force and time.time() - _checkpointed_at < OFFSET_CHECKPOINT_INTERVAL:
+            return
+        save_offset_db(_offset)
+        _checkpointed_offset = _offset
+        _checkpointed_at = time.time()
+
+
+@metrics.telegram_seconds.time(method="handle_updates")
+def handle_updates(
+    reddit,
+    created_redditor_queue,
+    removed_redditor_queue,
+    timeout=TELEGRAM_POLL_TIMEOUT,
+):
+    """Long-poll getUpdates once; returns False if the poll failed"""
     try:
-        updates = requests.get(url=url, params={"offset": offset}).json()
-        if len(updates["result"]) != 0:
-            save_offset_db(updates["result"][-1]["update_id"])
-            for update in updates["result"]:
-                print(f"received update :\n{update}")
-                chat_id = update["message"]["from"]["id"]
-                update_text = update["message"]["text"]
-                if "/add" in update_text:
-                    add_redditor(
-                        chat_id,
-                        update_text[len("/add") + 1 :].split(" "),
-                        reddit,
-                        created_redditor_queue,
-                    )
-
-                elif "/remove" in update_text:
-                    remove_redditor(
-                        chat_id,
-                        update_text[len("/remove") + 1 :],
-                        removed_redditor_queue,
-                    )
-                elif "/list" in update_text:
-                    list_redditors(chat_id)
-                elif "/mute" in update_text:
-                    mute_redditor(chat_id, update_text[len("/mute") + 1 :].split(" "))
-                elif "/unmute" in update_text:
-                    unmute_redditor(chat_id, update_text[len("/unmute") + 1 :])
-                elif "/giverockets" in update_text:
-                    give_rockets(
-                        chat_id, update_text[len("/giverockets") + 1 :].split(" ")
-                    )
+        updates = _updates_session.get(
+            url=f"{TELEGRAM_URL}/getUpdates",
+            params={"offset": get_offset() + 1, "timeout": timeout},
+            timeout=timeout + 10,
+        ).json()
+        for update in updates["result"]:
+            process_update(
+                update, reddit, created_redditor_queue, removed_redditor_queue
+            )
+        checkpoint_offset()
+        return True
 
     except Exception as e:
         print(f"Error in telegram update handler: {e}")
         print(traceback.format_exc())
+        return False
 
 
-def send_message(message, chat_ids):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    response = []
-    for id in chat_ids:
-        params = {"chat_id": id, "text": message}
+def claim_update(update):
+    """Advance the offset past ``update``; False if it was already handled"""
+    global _offset
+    get_offset()
+    with _offset_lock:
+        if update["update_id"] <= _offset:
+            return False
+        _offset = update["update_id"]
+    log_event(log, logging.DEBUG, "update_received", update_id=update["update_id"])
+    return True
+
+
+def update_command(update):
+    """Return (chat_id, text) for a text message update, else None"""
+    message = update.get("message")
+    if not message or "text" not in message:
+        return None
+    return message["from"]["id"], message["text"]
+
+
+def process_update(update, reddit, created_redditor_queue, removed_redditor_queue):
+    """Handle one update from getUpdates or the webhook, skipping repeats"""
+    if not claim_update(update):
+        return
+    command = update_command(update)
+    if command is None:
+        return
+    handle_command(
+        command[0],
+        command[1],
+        reddit,
+        created_redditor_queue,
+        removed_redditor_queue,
+    )
+
+
+class Command:
+    """Routing entry: handler plus the arguments it needs.
+
+    ``args`` is the number of required arguments, ``optional`` how many more
+    may follow (None for any number), ``numeric`` the positions that must
+    parse as integers and ``usage`` the reply when either check fails.
+    """
+
+    __slots__ = ("handler", "args", "optional", "numeric", "usage")
+
+    def __init__(self, handler, usage, args=0, numeric=(), optional=0):
+        self.handler = handler
+        self.args = args
+        self.optional = optional
+        self.numeric = numeric
+        self.usage = usage
+
+    def validate(self, args):
+        if len(args) < self.args:
+            return False
+        if self.optional is not None and len(args) > self.args + self.optional:
+            return False
+        for index in self.numeric:
+            if index >= len(args):
+                continue
+            try:
+                int(args[index])
+            except ValueError:
+                return False
+        return True
+
+
+class CommandContext:
+    __slots__ = ("reddit", "created_redditor_queue", "removed_redditor_queue")
+
+    def __init__(self, reddit, created_redditor_queue, removed_redditor_queue):
+        self.reddit = reddit
+        self.created_redditor_queue = created_redditor_queue
+        self.removed_redditor_queue = removed_redditor_queue
 
-        response.append(requests.post(url, data=params).json())
-    return response
+
+COMMANDS = {
+    "/add": Command(
+        lambda chat_id, args, context: add_redditor(
+            chat_id, args, context.reddit, context.created_redditor_queue
+        ),
+        args=2,
+        numeric=(1,),
+        usage="💩missing arguments: /add <redditor> <rating 1-10>",
+    ),
+    "/remove": Command(
+        lambda chat_id, args, context: remove_redditor(
+            chat_id, args[0], context.removed_redditor_queue
+        ),
+        args=1,
+        usage="💩missing argument. correct ussage: /remove <redditor>",
+    ),
+    "/list": Command(
+        lambda chat_id, args, context: list_redditors(chat_id),
+        usage="💩correct ussage: /list",
+    ),
+    "/mute": Command(
+        lambda chat_id, args, context: mute_redditor(chat_id, args),
+        args=2,
+        numeric=(1,),
+        usage="💩missing argument. correct ussage: /mute <redditor> <days>",
+    ),
+    "/unmute": Command(
+        lambda chat_id, args, context: unmute_redditor(chat_id, args[0]),
+        args=1,
+        usage="💩missing argument. correct ussage: /unmute <redditor>",
+    ),
+    "/giverockets": Command(
+        lambda chat_id, args, context: give_rockets(chat_id, args),
+        args=2,
+        numeric=(1,),
+        usage="💩missing argument. correct ussage: /giverockets <redditor> <amount>",
+    ),
+    "/ratelimit": Command(
+        lambda chat_id, args, context: reddit_budget(chat_id),
+        usage="💩correct ussage: /ratelimit",
+    ),
+    "/subscribe": Command(
+        lambda chat_id, args, context: subscribe(chat_id, args),
+        args=1,
+        optional=2,
+        numeric=(1,),
+        usage="💩correct ussage: /subscribe <redditor|*> [min rating] [subreddit]",
+    ),
+    "/unsubscribe": Command(
+        lambda chat_id, args, context: unsubscribe(chat_id, args[0]),
+        args=1,
+        usage="💩missing argument. correct ussage: /unsubscribe <redditor|*>",
+    ),
+    "/subscriptions": Command(
+        lambda chat_id, args, context: list_subscriptions(chat_id),
+        usage="💩correct ussage: /subscriptions",
+    ),
+    "/rules": Command(
+        lambda chat_id, args, context: list_rules(chat_id),
+        usage="💩correct ussage: /rules",
+    ),
+    "/addrule": Command(
+        lambda chat_id, args, context: add_rule(chat_id, args),
+        args=2,
+        usage=f"💩correct ussage: /addrule <{'|'.join(rules.KINDS)}> <value>",
+    ),
+    "/removerule": Command(
+        lambda chat_id, args, context: remove_rule(chat_id, args),
+        args=2,
+        usage=f"💩correct ussage: /removerule <{'|'.join(rules.KINDS)}> <value>",
+    ),
+    "/feeds": Command(
+        lambda chat_id, args, context: list_feeds(chat_id),
+        usage="💩correct ussage: /feeds",
+    ),
+    "/search": Command(
+        lambda chat_id, args, context: search(chat_id, args),
+        args=1,
+        optional=None,
+        usage="💩correct ussage: /search <words...> [@redditor]",
+    ),
+}
+
+# Called as listener(name, args) after a command's handler returns; the
+# sharded coordinator uses this to tell workers to reload what changed.
+command_listeners = []
+
+# Callables returning (redditor, kind, armed, next poll in seconds) rows for
+# /feeds; main.py registers its scheduler's snapshot.
+feed_sources = []
+
+# Commands run on a small pool so a slow /add (it asks Reddit whether the
+# account exists) does not hold up other chats. Commands from the same chat
+# still run, and reply, in the order they were sent.
+_command_executor = KeyedExecutor(COMMAND_WORKERS, "commands")
+
+
+def parse_command(update_text):
+    """Split ``/cmd@botname arg ...`` into ("/cmd", [arg, ...])"""
+    parts = update_text.split()
+    if not parts or not parts[0].startswith("/"):
+        return None, []
+    return parts[0].split("@", 1)[0].lower(), parts[1:]
+
+
+def run_command(chat_id, update_text, context):
+    name, args = parse_command(update_text)
+    command = COMMANDS.get(name)
+    if command is None:
+        return
+    if not command.validate(args):
+        send_message(chat_ids=[chat_id], message=command.usage)
+        return
+    try:
+        command.handler(chat_id, args, context)
+        for listener in command_listeners:
+            listener(name, args)
+    except Exception as e:
+        print(f"Error handling {name} for {chat_id}: {e}")
+        print(traceback.format_exc())
+
+
+def handle_command(
+    chat_id, update_text, reddit, created_redditor_queue, removed_redditor_queue
+):
+    context = CommandContext(reddit, created_redditor_queue, removed_redditor_queue)
+    return _command_executor.submit(chat_id, run_command, chat_id, update_text, context)
+
+
+def send_message(message, chat_ids):
+    return get_dispatcher().broadcast(message, chat_ids)
 
 
 def add_redditor(chat_id, args, reddit, created_redditors_queue):
-    if len(args) != 2:
+    exists = resolver.check(reddit, args[0])
+    if exists is None:
         send_message(
-            chat_ids=[chat_id],
-            message="💩missing arguments: /add <redditor> <rating 1-10>",
+            chat_ids=[chat_id], message="💩could not reach reddit, try again later"
         )
-    elif not check_redditor_exists(reddit, args[0]):
+    elif not exists:
         send_message(chat_ids=[chat_id], message="💩redditor does not exist")
     elif int(args[1]) < 1 or int(args[1]) > 10:
         send_message(chat_ids=[chat_id], message="💩rating must be between 1 - 10")
@@ -89,14 +326,7 @@ def list_redditors(chat_id):
 
 
 def mute_redditor(chat_id, args):
-    redditors = list_redditors_db()
-    redditors = [redditor[0] for redditor in redditors]
-    if len(args) != 2:
-        send_message(
-            chat_ids=[chat_id],
-            message="💩missing argument. correct ussage: /mute <redditor> <days>",
-        )
-    elif args[0] not in redditors:
+    if not watchlist.contains(args[0]):
         send_message(
             chat_ids=[chat_id], message="💩redditor to mute could not be found"
         )
@@ -109,9 +339,7 @@ def mute_redditor(chat_id, args):
 
 
 def remove_redditor(chat_id, redditor, removed_redditor_queue):
-    redditors = list_redditors_db()
-    redditors = [redditor[0] for redditor in redditors]
-    if redditor not in redditors:
+    if not watchlist.contains(redditor):
         send_message(
             message=f"💩couldn't find {redditor} in database. check spelling",
             chat_ids=[chat_id],
@@ -127,10 +355,7 @@ def remove_redditor(chat_id, redditor, removed_redditor_queue):
 
 
 def unmute_redditor(chat_id, redditor):
-    redditors = list_redditors_db()
-    redditors = [redditor[0] for redditor in redditors]
-
-    if redditor not in redditors:
+    if not watchlist.contains(redditor):
         send_message(
             chat_ids=[chat_id], message="💩redditor to mute could not be found"
         )
@@ -141,16 +366,7 @@ def unmute_redditor(chat_id, redditor):
 
 
 def give_rockets(chat_id, args):
-    redditors = list_redditors_db()
-    redditors = [redditor[0] for redditor in redditors]
-
-    if len(args) != 2:
-        send_message(
-            chat_ids=[chat_id],
-            message="💩missing argument. correct ussage: /giverockets <redditor> <amount>",
-        )
-
-    elif args[0] not in redditors:
+    if not watchlist.contains(args[0]):
         send_message(
             chat_ids=[chat_id], message="💩redditor to promote could not be found"
         )
@@ -159,3 +375,123 @@ def give_rockets(chat_id, args):
     else:
         give_rockets_db(args[0], args[1])
         send_message(message=f"changed rating of {args[0]}", chat_ids=(chat_id,))
+
+
+def reddit_budget(chat_id):
+    metrics = governor.metrics()
+    message = "reddit api budget:\n"
+    for name, value in metrics.items():
+        message += f"{name}: {value}\n"
+    send_message(message=message, chat_ids=[chat_id])
+
+
+def list_feeds(chat_id):
+    rows = [row for source in feed_sources for row in source()]
+    arming = sum(1 for row in rows if not row[2])
+    message = f"feeds: {len(rows)} live, {arming} arming\n"
+    for redditor, kind, armed, next_poll in rows[:50]:
+        message += f"{redditor} {kind}: next poll in {int(next_poll)}s"
+        message += "\n" if armed else " (arming)\n"
+    if len(rows) > 50:
+        message += f"... and {len(rows) - 50} more\n"
+    send_message(message=message, chat_ids=[chat_id])
+
+
+def subscribe(chat_id, args):
+    redditor = args[0]
+    if redditor != subscriptions.ALL and not watchlist.contains(redditor):
+        send_message(
+            chat_ids=[chat_id], message="💩redditor to subscribe to could not be found"
+        )
+        list_redditors(chat_id)
+        return
+    min_rating = int(args[1]) if len(args) > 1 else 0
+    subreddit = args[2].removeprefix("r/") if len(args) > 2 else None
+    if subscribe_db(chat_id, redditor, min_rating, subreddit):
+        send_message(chat_ids=[chat_id], message=f"subscribed to {redditor}🔔")
+
+
+def unsubscribe(chat_id, redditor):
+    if unsubscribe_db(chat_id, redditor):
+        send_message(chat_ids=[chat_id], message=f"unsubscribed from {redditor}🔕")
+    else:
+        send_message(
+            chat_ids=[chat_id], message=f"💩you are not subscribed to {redditor}"
+        )
+
+
+def list_subscriptions(chat_id):
+    message = "subscriptions:\n"
+    for subscription in subscriptions.for_chat(chat_id):
+        message += subscription.redditor
+        if subscription.min_rating:
+            message += f" (rating >= {subscription.min_rating})"
+        if subscription.subreddit:
+            message += f" in r/{subscription.subreddit}"
+        message += "\n"
+    send_message(message=message, chat_ids=[chat_id])
+
+
+def list_rules(chat_id):
+    message = "rules:\n"
+    for kind, value in rules.rows():
+        message += f"{kind}: {value}\n"
+    send_message(message=message, chat_ids=[chat_id])
+
+
+def search(chat_id, args):
+    # every word is part of the query, a trailing @name narrows it to one redditor
+    words = list(args)
+    redditor = None
+    if len(words) > 1 and words[-1].startswith("@"):
+        redditor = words.pop()[1:]
+    query = " ".join(words)
+    results = archive.search(query, redditor)
+    if results is None:
+        send_message(chat_ids=[chat_id], message="💩search failed")
+        return
+    if not results:
+        send_message(chat_ids=[chat_id], message=f"nothing found for {query}")
+        return
+    message = f"results for {query}:\n"
+    for redditor, kind, subreddit, created_utc, title, body, permalink in results:
+        day = time.strftime("%Y-%m-%d", time.localtime(created_utc))
+        text = body if kind == "comments" else title
+        if len(text) > 200:
+            text = text[:200] + "…"
+        message += f"\n{redditor} in r/{subreddit} on {day}:\n{text}\nwww.reddit.com{permalink}\n"
+    send_message(message=message, chat_ids=[chat_id])
+
+
+def parse_rule(chat_id, args):
+    kind = args[0].lower()
+    try:
+        if kind not in rules.KINDS:
+            raise ValueError(kind)
+        return kind, rules.normalize(kind, args[1])
+    except ValueError:
+        send_message(
+            chat_ids=[chat_id],
+            message=f"💩invalid rule. kinds: {', '.join(rules.KINDS)}",
+        )
+        return None
+
+
+def add_rule(chat_id, args):
+    rule = parse_rule(chat_id, args)
+    if rule is None:
+        return
+    if add_rule_db(*rule):
+        send_message(chat_ids=[chat_id], message=f"rule added: {rule[0]} {rule[1]}📏")
+    else:
+        send_message(chat_ids=[chat_id], message="💩rule already exists")
+
+
+def remove_rule(chat_id, args):
+    rule = parse_rule(chat_id, args)
+    if rule is None:
+        return
+    if remove_rule_db(*rule):
+        send_message(chat_ids=[chat_id], message=f"rule removed: {rule[0]} {rule[1]}")
+    else:
+        send_message(chat_ids=[chat_id], message="💩no such rule. see /rules")
@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import deque
+
+from utils.db import (
+    append_archive_db,
+    init_archive_db,
+    prune_archive_db,
+    search_archive_db,
+)
+from utils.settings import (
+    ARCHIVE_BATCH,
+    ARCHIVE_FLUSH_INTERVAL,
+    ARCHIVE_RETENTION,
+    ARCHIVE_SEARCH_LIMIT,
+)
+
+# Local copy of every new comment and submission the observers see, alerted
+# on or not, so /search can answer from wsbwatch.db instead of Reddit.
+# record() only appends to an in-memory buffer; a writer thread inserts it in
+# one transaction per ARCHIVE_BATCH rows and prunes rows past retention.
+# If the writer falls far behind, the oldest buffered rows are dropped rather
+# than letting the buffer grow without bound.
+
+_buffer = deque(maxlen=ARCHIVE_BATCH * 20)
+_condition = threading.Condition()
+_stopping = False
+_thread = None
+
+
+def record(event, title, body):
+    """Queue an AlertEvent's item for the archive"""
+    row = (
+        event.fullname,
+        event.redditor,
+        event.kind,
+        event.subreddit,
+        event.created,
+        title or "",
+        body or "",
+        event.permalink,
+        event.url,
+        event.score,
+    )
+    with _condition:
+        _buffer.append(row)
+        if len(_buffer) >= ARCHIVE_BATCH:
+            _condition.notify()
+
+
+def flush():
+    """Write everything buffered so far"""
+    while True:
+        with _condition:
+            batch = [_buffer.popleft() for _ in range(min(ARCHIVE_BATCH, len(_buffer)))]
+        if not batch:
+            return
+        if not append_archive_db(batch):
+            # keep the rows for the next attempt
+            with _condition:
+                _buffer.extendleft(reversed(batch))
+            return
+
+
+def _work():
+    last_prune = 0
+    while True:
+        with _condition:
+            if not _stopping and len(_buffer) < ARCHIVE_BATCH:
+                _condition.wait(ARCHIVE_FLUSH_INTERVAL)
+            stopping = _stopping
+        flush()
+        if stopping:
+            return
+        if time.time() - last_prune > 60 * 60:
+            prune_archive_db(time.time() - ARCHIVE_RETENTION)
+            last_prune = time.time()
+
+
+def start():
+    global _thread, _stopping
+    init_archive_db()
+    _stopping = False
+    _thread = threading.Thread(target=_work, name="archive")
+    _thread.daemon = True
+    _thread.start()
+
+
+def close():
+    """Stop the writer after it flushed the buffer"""
+    global _stopping
+    with _condition:
+        _stopping = True
+        _condition.notify()
+    if _thread:
+        _thread.join()
+
+
+def fts_query(text):
+    """Quote each word so user input is never parsed as FTS5 syntax"""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+def search(text, redditor=None, limit=ARCHIVE_SEARCH_LIMIT):
+    """Newest archived items containing every word of ``text``"""
+    query = fts_query(text)
+    if not query:
+        return []
+    return search_archive_db(query, redditor, limit)
@@ -1,12 +1,166 @@
 import sqlite3
+import threading
 import time
+from contextlib import contextmanager
+
+from utils import rules, subscriptions, watchlist
+from utils.metrics import db_seconds
 
 DB_PATH = "utils/wsbwatch.db"
 
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def get_connection():
+    """Return this thread's connection, opening it on first use.
+
+    Connections stay open for the life of the thread so sqlite3 can reuse its
+    prepared statement cache instead of reparsing every query.
+    """
+    connection = getattr(_local, "connection", None)
+    if connection is None or getattr(_local, "path", None) != DB_PATH:
+        connection = sqlite3.connect(DB_PATH, timeout=30, cached_statements=256)
+        connection.execute("PRAGMA journal_mode=WAL;")
+        connection.execute("PRAGMA synchronous=NORMAL;")
+        _local.connection = connection
+        _local.path = DB_PATH
+    return connection
+
+
+def timed(function):
+    """Record the call's latency in redditwatch_db_seconds"""
+    return db_seconds.time(call=function.__name__)(function)
+
+
+@contextmanager
+def read_connection():
+    yield get_connection()
+
+
+@contextmanager
+def write_connection():
+    """Serialize writers across threads and commit (or roll back) on exit"""
+    with _write_lock:
+        connection = get_connection()
+        with connection:
+            yield connection
+
+
+# Schema migrations, applied in order by migrate_db(). PRAGMA user_version
+# records how many have run. Tables that belong to one feature (seen items,
+# outbox, archive, ...) are created and indexed by that feature's init_*_db,
+# which migrate_db() runs afterwards.
+
+
+def _create_base_tables(cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS redditors (id INTEGER PRIMARY KEY, user_name TEXT, rating INTEGER, mute_timer REAL);"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, name TEXT, chat_id INTEGER);"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS offset (id INTEGER PRIMARY KEY, offset INTEGER);"
+    )
+
+
+def _index_user_names(cursor):
+    # a name added twice before the index existed keeps its first row
+    cursor.execute(
+        "DELETE FROM redditors WHERE id NOT IN (SELECT MIN(id) FROM redditors GROUP BY user_name);"
+    )
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS redditors_user_name ON redditors (user_name);"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_name ON users (name);")
+
+
+def _single_row_offset(cursor):
+    cursor.execute(
+        "CREATE TABLE offset_row (id INTEGER PRIMARY KEY CHECK (id = 1), offset INTEGER NOT NULL);"
+    )
+    cursor.execute(
+        "INSERT INTO offset_row (id, offset) SELECT 1, offset FROM offset WHERE offset IS NOT NULL ORDER BY id DESC LIMIT 1;"
+    )
+    cursor.execute("DROP TABLE offset;")
+    cursor.execute("ALTER TABLE offset_row RENAME TO offset;")
+
+
+def _nocase_user_names(cursor):
+    # Reddit names are case-insensitive: "Foo" and "foo" are one redditor
+    cursor.execute(
+        "DELETE FROM redditors WHERE id NOT IN (SELECT MIN(id) FROM redditors GROUP BY user_name COLLATE NOCASE);"
+    )
+    cursor.execute("DROP INDEX IF EXISTS redditors_user_name;")
+    cursor.execute(
+        "CREATE UNIQUE INDEX redditors_user_name ON redditors (user_name COLLATE NOCASE);"
+    )
+
+
+def _lower_seen_names(cursor):
+    # seen_items and watermarks keyed redditors by the name as typed; fold
+    # them like everything else, keeping the newest watermark of each name
+    tables = {
+        row[0]
+        for row in cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('seen_items', 'watermarks');"
+        )
+    }
+    if "watermarks" in tables:
+        cursor.execute(
+            "UPDATE watermarks SET created_utc = (SELECT MAX(other.created_utc) FROM watermarks AS other WHERE lower(trim(other.redditor)) = lower(trim(watermarks.redditor)) AND other.kind = watermarks.kind);"
+        )
+        cursor.execute(
+            "UPDATE OR IGNORE watermarks SET redditor = lower(trim(redditor));"
+        )
+        cursor.execute("DELETE FROM watermarks WHERE redditor != lower(trim(redditor));")
+    if "seen_items" in tables:
+        cursor.execute(
+            "UPDATE OR IGNORE seen_items SET redditor = lower(trim(redditor));"
+        )
+        cursor.execute("DELETE FROM seen_items WHERE redditor != lower(trim(redditor));")
+
+
+MIGRATIONS = (
+    _create_base_tables,
+    _index_user_names,
+    _single_row_offset,
+    _nocase_user_names,
+    _lower_seen_names,
+)
+
 
+@timed
+def migrate_db():
+    """Bring wsbwatch.db up to date; returns the schema version or None"""
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+            for number in range(version, len(MIGRATIONS)):
+                # each step commits together with its version bump
+                cursor.execute("BEGIN;")
+                MIGRATIONS[number](cursor)
+                cursor.execute(f"PRAGMA user_version = {number + 1};")
+                connection.commit()
+                version = number + 1
+    except sqlite3.Error as e:
+        print(f"Error occurred in migrate_db: {e}")
+        return None
+    init_seen_db()
+    init_outbox_db()
+    init_subscriptions_db()
+    init_rules_db()
+    init_archive_db()
+    init_accounts_db()
+    return version
+
+
+@timed
 def list_redditors_db():
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with read_connection() as connection:
             cursor = connection.cursor()
             sql_statement = "SELECT user_name, rating FROM redditors;"
             redditors = cursor.execute(sql_statement).fetchall()
@@ -16,78 +170,91 @@ def list_redditors_db():
         return None
 
 
+@timed
+def load_watchlist_db():
+    """Fill the in-memory watchlist from the redditors table"""
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            sql_statement = "SELECT user_name, rating, mute_timer FROM redditors;"
+            watchlist.load(cursor.execute(sql_statement).fetchall())
+    except sqlite3.Error as e:
+        print(f"Error occurred in load_watchlist: {e}")
+
+
+@timed
 def add_redditor_db(redditor, ranking=None):
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with write_connection() as connection:
             cursor = connection.cursor()
-            if ranking:
-                sql_statement = "INSERT INTO redditors (user_name, rating, mute_timer) VALUES (?, ?, 0);"
-                cursor.execute(sql_statement, (redditor, ranking))
-            else:
-                sql_statement = "INSERT INTO redditors (user_name, rating, mute_timer) VALUES (?, 1, 0);"
-                cursor.execute(sql_statement, (redditor,))
-            connection.commit()
-            return cursor.lastrowid
+            # adding a watched redditor again only changes its rating
+            sql_statement = "INSERT INTO redditors (user_name, rating, mute_timer) VALUES (?, ?, 0) ON CONFLICT (user_name COLLATE NOCASE) DO UPDATE SET rating = excluded.rating;"
+            cursor.execute(sql_statement, (redditor, ranking or 1))
+            watchlist.set_rating(redditor, ranking or 1)
+            # lastrowid is stale when the upsert took the UPDATE branch
+            return cursor.rowcount
     except sqlite3.Error as e:
         print(f"Error occurred in add_redditor: {e}")
         return None
 
 
+@timed
 def remove_redditor_db(redditor):
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with write_connection() as connection:
             cursor = connection.cursor()
-            sql_statement = "DELETE FROM redditors WHERE user_name = ?;"
+            sql_statement = "DELETE FROM redditors WHERE user_name = ? COLLATE NOCASE;"
             cursor.execute(sql_statement, (redditor,))
-            connection.commit()
+            watchlist.discard(redditor)
             return cursor.rowcount > 0  # Returns True if a row was deleted
     except sqlite3.Error as e:
         print(f"Error occurred in remove_redditor: {e}")
         return False
 
 
+@timed
 def add_bot_user_db(user, chat_id):
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with write_connection() as connection:
             cursor = connection.cursor()
             sql_statement = "INSERT INTO users (name, chat_id) VALUES (?, ?);"
             cursor.execute(sql_statement, (user, chat_id))
-            connection.commit()
             return cursor.lastrowid
     except sqlite3.Error as e:
         print(f"Error occurred in add_bot_user: {e}")
         return None
 
 
+@timed
 def remove_bot_user_db(user):
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with write_connection() as connection:
             cursor = connection.cursor()
             sql_statement = "DELETE FROM users WHERE name = ?;"
             cursor.execute(sql_statement, (user,))
-            connection.commit()
             return cursor.rowcount > 0  # Returns True if a row was deleted
     except sqlite3.Error as e:
         print(f"Error occurred in remove_bot_user: {e}")
         return False
 
 
+@timed
 def save_offset_db(offset):
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with write_connection() as connection:
             cursor = connection.cursor()
-            sql_statement = "INSERT INTO offset (offset) VALUES (?);"
+            sql_statement = "INSERT INTO offset (id, offset) VALUES (1, ?) ON CONFLICT (id) DO UPDATE SET offset = excluded.offset;"
             cursor.execute(sql_statement, (offset,))
-            connection.commit()
     except sqlite3.Error as e:
         print(f"Error occurred in save_offset: {e}")
 
 
+@timed
 def get_offset_db():
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with read_connection() as connection:
             cursor = connection.cursor()
-            sql_statement = "SELECT offset FROM offset ORDER BY id DESC LIMIT 1;"
+            sql_statement = "SELECT offset FROM offset WHERE id = 1;"
             cursor.execute(sql_statement)
             result = cursor.fetchone()
             return result[0] if result else 0
@@ -95,9 +262,10 @@ def get_offset_db():
         print(f"Error occurred in get_offset: {e}")
 
 
+@timed
 def get_chat_ids():
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with read_connection() as connection:
             cursor = connection.cursor()
             sql_statement = "SELECT chat_id FROM users;"
             cursor.execute(sql_statement)
@@ -107,33 +275,35 @@ def get_chat_ids():
         print(f"Error occurred in get_chat_ids: {e}")
 
 
+@timed
 def mute_redditor_db(redditor, mute_time):
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with write_connection() as connection:
             cursor = connection.cursor()
-            sql_statement = "UPDATE redditors SET mute_timer = ? WHERE user_name = ?;"
+            sql_statement = "UPDATE redditors SET mute_timer = ? WHERE user_name = ? COLLATE NOCASE;"
             current_time = time.time()
             mute_time_in_seconds = 24 * 60 * 60 * int(mute_time)
             time_until_unmute = current_time + mute_time_in_seconds
             cursor.execute(sql_statement, (time_until_unmute, redditor))
-            connection.commit()
+            watchlist.set_mute(redditor, time_until_unmute)
     except sqlite3.Error as e:
         print(f"Error occurred in mute_redditor_db: {e}")
 
 
+@timed
 def is_muted(redditor):
+    if watchlist.is_loaded():
+        return watchlist.is_muted(redditor)
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with read_connection() as connection:
             cursor = connection.cursor()
-            sql_statement = "SELECT mute_timer FROM redditors WHERE user_name = ?;"
+            sql_statement = "SELECT mute_timer FROM redditors WHERE user_name = ? COLLATE NOCASE;"
             cursor.execute(sql_statement, (redditor,))
             user_mute_timer = cursor.fetchone()
             if user_mute_timer[0] is None:
                 return False
             current_time = time.time()
-            print(user_mute_timer[0])
             if float(user_mute_timer[0]) > current_time:
-                print(f"{redditor} is muted")
                 return True
             else:
                 return False
@@ -141,37 +311,532 @@ def is_muted(redditor):
         print(f"Error occured in is_muted: {e}")
 
 
+@timed
 def unmute_redditor_db(redditor):
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with write_connection() as connection:
             cursor = connection.cursor()
-            sql_statement = "UPDATE redditors SET mute_timer = ? WHERE user_name = ?;"
+            sql_statement = "UPDATE redditors SET mute_timer = ? WHERE user_name = ? COLLATE NOCASE;"
             time_until_unmute = 0.0
             cursor.execute(sql_statement, (time_until_unmute, redditor))
-            connection.commit()
+            watchlist.set_mute(redditor, time_until_unmute)
     except sqlite3.Error as e:
         print(f"Error occurred in unmute_redditor_db: {e}")
 
 
+@timed
 def give_rockets_db(redditor, amount):
     try:
-        with sqlite3.connect(DB_PATH) as connection:
-            rating = get_rating(redditor) + int(amount)
+        with write_connection() as connection:
             cursor = connection.cursor()
-            sql_statement = "UPDATE redditors SET rating = ? WHERE user_name = ?;"
-            cursor.execute(sql_statement, (rating, redditor))
-            connection.commit()
+            sql_statement = "UPDATE redditors SET rating = rating + ? WHERE user_name = ? COLLATE NOCASE;"
+            cursor.execute(sql_statement, (int(amount), redditor))
+            watchlist.add_rating(redditor, amount)
     except sqlite3.Error as e:
         print(f"Error occurred in give_rockets_db: {e}")
 
 
+@timed
 def get_rating(redditor):
     try:
-        with sqlite3.connect(DB_PATH) as connection:
+        with read_connection() as connection:
             cursor = connection.cursor()
-            sql_statement = "SELECT rating FROM redditors WHERE user_name = ?;"
+            sql_statement = "SELECT rating FROM redditors WHERE user_name = ? COLLATE NOCASE;"
             cursor.execute(sql_statement, (redditor,))
             result = cursor.fetchone()
             return int(result[0])
     except sqlite3.Error as e:
         print(f"Error occurred in get_rating: {e}")
+
+
+@timed
+def init_seen_db():
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS seen_items (redditor TEXT NOT NULL, kind TEXT NOT NULL, fullname TEXT NOT NULL, created_utc REAL NOT NULL, PRIMARY KEY (redditor, kind, fullname));"
+            )
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks (redditor TEXT NOT NULL, kind TEXT NOT NULL, created_utc REAL NOT NULL, PRIMARY KEY (redditor, kind));"
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in init_seen_db: {e}")
+
+
+@timed
+def load_seen_db():
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            items = cursor.execute(
+                "SELECT redditor, kind, fullname FROM seen_items ORDER BY created_utc;"
+            ).fetchall()
+            watermarks = cursor.execute(
+                "SELECT redditor, kind, created_utc FROM watermarks;"
+            ).fetchall()
+            return items, watermarks
+    except sqlite3.Error as e:
+        print(f"Error occurred in load_seen_db: {e}")
+        return [], []
+
+
+@timed
+def save_seen_db(redditor, kind, fullname, created_utc, evicted=None):
+    redditor = redditor.strip().lower()
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO seen_items (redditor, kind, fullname, created_utc) VALUES (?, ?, ?, ?);",
+                (redditor, kind, fullname, created_utc),
+            )
+            if evicted:
+                cursor.execute(
+                    "DELETE FROM seen_items WHERE redditor = ? AND kind = ? AND fullname = ?;",
+                    (redditor, kind, evicted),
+                )
+            cursor.execute(
+                "INSERT INTO watermarks (redditor, kind, created_utc) VALUES (?, ?, ?) ON CONFLICT (redditor, kind) DO UPDATE SET created_utc = MAX(created_utc, excluded.created_utc);",
+                (redditor, kind, created_utc),
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in save_seen_db: {e}")
+
+
+@timed
+def save_watermark_db(redditor, kind, created_utc):
+    redditor = redditor.strip().lower()
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO watermarks (redditor, kind, created_utc) VALUES (?, ?, ?);",
+                (redditor, kind, created_utc),
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in save_watermark_db: {e}")
+
+
+@timed
+def remove_seen_db(redditor):
+    redditor = redditor.strip().lower()
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM seen_items WHERE redditor = ?;", (redditor,))
+            cursor.execute("DELETE FROM watermarks WHERE redditor = ?;", (redditor,))
+    except sqlite3.Error as e:
+        print(f"Error occurred in remove_seen_db: {e}")
+
+
+@timed
+def init_outbox_db():
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, message TEXT NOT NULL, created REAL NOT NULL, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL DEFAULT 0, delivered REAL);"
+            )
+            columns = {row[1] for row in cursor.execute("PRAGMA table_info(outbox);")}
+            # digest columns came later, add them to outboxes created before
+            for column, definition in (
+                ("method", "TEXT NOT NULL DEFAULT 'sendMessage'"),
+                ("digest", "TEXT"),
+                ("message_id", "INTEGER"),
+            ):
+                if column not in columns:
+                    cursor.execute(f"ALTER TABLE outbox ADD COLUMN {column} {definition};")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (chat_id, id) WHERE status = 'pending';"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_digest ON outbox (digest, chat_id) WHERE digest IS NOT NULL;"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_delivered ON outbox (delivered) WHERE status != 'pending';"
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in init_outbox_db: {e}")
+
+
+@timed
+def append_outbox_db(rows):
+    """Insert (chat_id, message, created, method, digest) rows in one transaction"""
+    try:
+        with write_connection() as connection:
+            connection.executemany(
+                "INSERT INTO outbox (chat_id, message, created, method, digest) VALUES (?, ?, ?, ?, ?);",
+                rows,
+            )
+        return True
+    except sqlite3.Error as e:
+        print(f"Error occurred in append_outbox_db: {e}")
+        return False
+
+
+@timed
+def count_outbox_db():
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending';")
+            return cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Error occurred in count_outbox_db: {e}")
+        return 0
+
+
+@timed
+def due_outbox_chats_db(now):
+    """Chats whose oldest pending row is due for a (re)try"""
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT chat_id FROM outbox WHERE id IN (SELECT MIN(id) FROM outbox WHERE status = 'pending' GROUP BY chat_id) AND next_attempt <= ?;",
+                (now,),
+            )
+            return [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Error occurred in due_outbox_chats_db: {e}")
+        return []
+
+
+@timed
+def pending_outbox_db(chat_id, limit):
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT id, message, attempts, method, digest FROM outbox WHERE status = 'pending' AND chat_id = ? ORDER BY id LIMIT ?;",
+                (chat_id, limit),
+            )
+            return cursor.fetchall()
+    except sqlite3.Error as e:
+        print(f"Error occurred in pending_outbox_db: {e}")
+        return []
+
+
+@timed
+def mark_outbox_db(id, status, message_id=None):
+    """Close a pending row; returns False if it was already closed"""
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "UPDATE outbox SET status = ?, delivered = ?, message_id = ? WHERE id = ? AND status = 'pending';",
+                (status, time.time(), message_id, id),
+            )
+            return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        print(f"Error occurred in mark_outbox_db: {e}")
+        return False
+
+
+@timed
+def digest_message_db(chat_id, digest):
+    """Telegram message id of the last delivered message of a digest"""
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT message_id FROM outbox WHERE digest = ? AND chat_id = ? AND message_id IS NOT NULL ORDER BY id DESC LIMIT 1;",
+                (digest, chat_id),
+            )
+            result = cursor.fetchone()
+            return result[0] if result else None
+    except sqlite3.Error as e:
+        print(f"Error occurred in digest_message_db: {e}")
+        return None
+
+
+@timed
+def retry_outbox_db(id, next_attempt):
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt = ? WHERE id = ? AND status = 'pending';",
+                (next_attempt, id),
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in retry_outbox_db: {e}")
+
+
+@timed
+def prune_outbox_db(before):
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "DELETE FROM outbox WHERE status != 'pending' AND delivered < ?;",
+                (before,),
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in prune_outbox_db: {e}")
+
+
+@timed
+def init_subscriptions_db():
+    """Create the subscriptions table and the list of chats already seeded"""
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS subscriptions (chat_id INTEGER NOT NULL, redditor TEXT NOT NULL, min_rating INTEGER NOT NULL DEFAULT 0, subreddit TEXT, PRIMARY KEY (chat_id, redditor));"
+            )
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS seeded_chats (chat_id INTEGER PRIMARY KEY);"
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in init_subscriptions_db: {e}")
+
+
+@timed
+def seed_subscriptions_db():
+    """Give chats new to the users table a '*' subscription, once.
+
+    A chat that later unsubscribes from everything stays unsubscribed.
+    """
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO subscriptions (chat_id, redditor) SELECT DISTINCT chat_id, '*' FROM users WHERE chat_id NOT IN (SELECT chat_id FROM seeded_chats) AND chat_id NOT IN (SELECT chat_id FROM subscriptions);"
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO seeded_chats (chat_id) SELECT DISTINCT chat_id FROM users WHERE chat_id IS NOT NULL;"
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in seed_subscriptions_db: {e}")
+
+
+@timed
+def load_subscriptions_db():
+    """Fill the in-memory subscription index from the subscriptions table"""
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            sql_statement = (
+                "SELECT chat_id, redditor, min_rating, subreddit FROM subscriptions;"
+            )
+            subscriptions.load(cursor.execute(sql_statement).fetchall())
+    except sqlite3.Error as e:
+        print(f"Error occurred in load_subscriptions: {e}")
+
+
+@timed
+def subscribe_db(chat_id, redditor, min_rating=0, subreddit=None):
+    redditor = redditor.strip().lower()
+    subreddit = subreddit.lower() if subreddit else None
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "INSERT INTO subscriptions (chat_id, redditor, min_rating, subreddit) VALUES (?, ?, ?, ?) ON CONFLICT (chat_id, redditor) DO UPDATE SET min_rating = excluded.min_rating, subreddit = excluded.subreddit;",
+                (chat_id, redditor, min_rating, subreddit),
+            )
+            subscriptions.put(chat_id, redditor, min_rating, subreddit)
+            return True
+    except sqlite3.Error as e:
+        print(f"Error occurred in subscribe: {e}")
+        return False
+
+
+@timed
+def unsubscribe_db(chat_id, redditor):
+    redditor = redditor.strip().lower()
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "DELETE FROM subscriptions WHERE chat_id = ? AND redditor = ?;",
+                (chat_id, redditor),
+            )
+            subscriptions.discard(chat_id, redditor)
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        print(f"Error occurred in unsubscribe: {e}")
+        return False
+
+
+@timed
+def init_rules_db():
+    """Create the rules table, seeded with the filters the bot always had"""
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rules';"
+            )
+            if cursor.fetchone():
+                return
+            cursor.execute(
+                "CREATE TABLE rules (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, value TEXT NOT NULL, UNIQUE (kind, value));"
+            )
+            cursor.executemany(
+                "INSERT INTO rules (kind, value) VALUES (?, ?);", rules.DEFAULT_RULES
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in init_rules_db: {e}")
+
+
+@timed
+def load_rules_db():
+    """Recompile the alert filter from the rules table"""
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            sql_statement = "SELECT kind, value FROM rules ORDER BY id;"
+            rules.load(cursor.execute(sql_statement).fetchall())
+    except sqlite3.Error as e:
+        print(f"Error occurred in load_rules: {e}")
+
+
+@timed
+def add_rule_db(kind, value):
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            if kind in rules.SETTING_KINDS:
+                # settings hold a single value, a new one replaces the old
+                cursor.execute("DELETE FROM rules WHERE kind = ?;", (kind,))
+            cursor.execute(
+                "INSERT OR IGNORE INTO rules (kind, value) VALUES (?, ?);",
+                (kind, value),
+            )
+            added = cursor.rowcount > 0
+    except sqlite3.Error as e:
+        print(f"Error occurred in add_rule: {e}")
+        return False
+    load_rules_db()
+    return added
+
+
+@timed
+def remove_rule_db(kind, value):
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "DELETE FROM rules WHERE kind = ? AND value = ?;", (kind, value)
+            )
+            removed = cursor.rowcount > 0
+    except sqlite3.Error as e:
+        print(f"Error occurred in remove_rule: {e}")
+        return False
+    if removed:
+        load_rules_db()
+    return removed
+
+
+@timed
+def init_archive_db():
+    """Create the archive table and its FTS5 index over title and body"""
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS archive (fullname TEXT PRIMARY KEY, redditor TEXT NOT NULL, kind TEXT NOT NULL, subreddit TEXT NOT NULL, created_utc REAL NOT NULL, title TEXT NOT NULL, body TEXT NOT NULL, permalink TEXT NOT NULL, url TEXT, score INTEGER NOT NULL);"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS archive_created ON archive (created_utc);"
+            )
+            # external content: the index stores no second copy of the text
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(title, body, content='archive', content_rowid='rowid');"
+            )
+            cursor.execute(
+                "CREATE TRIGGER IF NOT EXISTS archive_insert AFTER INSERT ON archive BEGIN INSERT INTO archive_fts (rowid, title, body) VALUES (new.rowid, new.title, new.body); END;"
+            )
+            cursor.execute(
+                "CREATE TRIGGER IF NOT EXISTS archive_delete AFTER DELETE ON archive BEGIN INSERT INTO archive_fts (archive_fts, rowid, title, body) VALUES ('delete', old.rowid, old.title, old.body); END;"
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in init_archive_db: {e}")
+
+
+@timed
+def append_archive_db(rows):
+    """Insert archive rows in one transaction; items already archived are kept"""
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.executemany(
+                "INSERT OR IGNORE INTO archive (fullname, redditor, kind, subreddit, created_utc, title, body, permalink, url, score) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                rows,
+            )
+            return True
+    except sqlite3.Error as e:
+        print(f"Error occurred in append_archive_db: {e}")
+        return False
+
+
+@timed
+def search_archive_db(query, redditor=None, limit=10):
+    """Newest archived items matching the FTS5 ``query``, or None on error"""
+    sql_statement = "SELECT archive.redditor, archive.kind, archive.subreddit, archive.created_utc, archive.title, archive.body, archive.permalink FROM archive_fts JOIN archive ON archive.rowid = archive_fts.rowid WHERE archive_fts MATCH ?"
+    params = [query]
+    if redditor:
+        sql_statement += " AND archive.redditor = ? COLLATE NOCASE"
+        params.append(redditor)
+    sql_statement += " ORDER BY archive.created_utc DESC LIMIT ?;"
+    params.append(limit)
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            return cursor.execute(sql_statement, params).fetchall()
+    except sqlite3.Error as e:
+        print(f"Error occurred in search_archive_db: {e}")
+        return None
+
+
+@timed
+def prune_archive_db(before):
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM archive WHERE created_utc < ?;", (before,))
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        print(f"Error occurred in prune_archive_db: {e}")
+        return 0
+
+
+@timed
+def init_accounts_db():
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS accounts (user_name TEXT PRIMARY KEY, fullname TEXT, alive INTEGER NOT NULL, checked REAL NOT NULL);"
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in init_accounts_db: {e}")
+
+
+@timed
+def load_accounts_db():
+    try:
+        with read_connection() as connection:
+            cursor = connection.cursor()
+            sql_statement = "SELECT user_name, fullname, alive, checked FROM accounts;"
+            return cursor.execute(sql_statement).fetchall()
+    except sqlite3.Error as e:
+        print(f"Error occurred in load_accounts_db: {e}")
+        return []
+
+
+@timed
+def save_accounts_db(rows):
+    """Upsert (user_name, fullname, alive, checked) rows in one transaction"""
+    try:
+        with write_connection() as connection:
+            cursor = connection.cursor()
+            cursor.executemany(
+                "INSERT INTO accounts (user_name, fullname, alive, checked) VALUES (?, ?, ?, ?) ON CONFLICT (user_name) DO UPDATE SET fullname = COALESCE(excluded.fullname, fullname), alive = excluded.alive, checked = excluded.checked;",
+                rows,
+            )
+    except sqlite3.Error as e:
+        print(f"Error occurred in save_accounts_db: {e}")
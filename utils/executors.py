@@ -0,0 +1,62 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class KeyedExecutor:
+    """Thread pool that runs tasks sharing a key one after another, in order.
+
+    Tasks with different keys run concurrently on up to ``workers`` threads.
+    """
+
+    def __init__(self, workers, name):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name
+        )
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            tasks = self._pending.get(key)
+            start = tasks is None
+            if start:
+                tasks = self._pending[key] = deque()
+            tasks.append((future, fn, args, kwargs))
+        if start:
+            self._executor.submit(self._drain, key)
+        return future
+
+    def pending(self):
+        with self._lock:
+            return sum(len(tasks) for tasks in self._pending.values())
+
+    def cancel_pending(self):
+        """Cancel every queued task; returns how many were dropped"""
+        with self._lock:
+            dropped = 0
+            for tasks in self._pending.values():
+                while tasks:
+                    future = tasks.popleft()[0]
+                    future.cancel()
+                    dropped += 1
+            return dropped
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                tasks = self._pending[key]
+                if not tasks:
+                    del self._pending[key]
+                    return
+                future, fn, args, kwargs = tasks.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
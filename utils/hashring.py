@@ -0,0 +1,39 @@
+import bisect
+import hashlib
+
+
+class HashRing:
+    """Consistent hash ring mapping keys to nodes.
+
+    Each node owns ``replicas`` points on the ring and a key belongs to the
+    first point at or after its own hash. Adding or removing a node only
+    moves the keys that node gains or loses.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}#{replica}")
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+            self._owners[point] = node
+
+    def remove(self, node):
+        self._points = [point for point in self._points if self._owners[point] != node]
+        self._owners = {point: self._owners[point] for point in self._points}
+
+    def node_for(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[self._points[index]]
@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+
+from utils.settings import LOG_LEVEL, LOG_RATE_BURST, LOG_RATE_INTERVAL
+
+
+class RateLimitFilter(logging.Filter):
+    """Drops repeats of the same event beyond ``burst`` per ``interval`` seconds.
+
+    The first record let through after a quiet spell reports how many were
+    dropped.
+    """
+
+    def __init__(self, burst=LOG_RATE_BURST, interval=LOG_RATE_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, getattr(record, "event", record.msg))
+        now = time.monotonic()
+        with self._lock:
+            started, count, dropped = self._windows.get(key, (now, 0, 0))
+            if now - started >= self.interval:
+                started, count = now, 0
+            if count >= self.burst:
+                self._windows[key] = (started, count, dropped + 1)
+                return False
+            self._windows[key] = (started, count + 1, 0)
+        record.dropped = dropped
+        return True
+
+
+class EventFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, "dropped", 0):
+            text += f" dropped={record.dropped}"
+        return text
+
+
+def log_event(logger, level, event, **fields):
+    """Log ``event key=value ...``; rate limiting groups records by event"""
+    if not logger.isEnabledFor(level):
+        return
+    text = " ".join([event] + [f"{key}={value!r}" for key, value in fields.items()])
+    logger.log(level, text, extra={"event": event})
+
+
+def setup_logging():
+    formatter = EventFormatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+
+    errors = logging.FileHandler("utils/errors.log")
+    errors.setLevel(logging.ERROR)
+    errors.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    )
+
+    console = logging.StreamHandler()
+    console.setLevel(LOG_LEVEL)
+    console.setFormatter(formatter)
+    console.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.setLevel(min(console.level, logging.ERROR))
+    root.addHandler(errors)
+    root.addHandler(console)
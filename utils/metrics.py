@@ -0,0 +1,191 @@
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal Prometheus-style metrics: counters, gauges and histograms with
+# labels, rendered in the text exposition format on /metrics.
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _label_text(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value)}"' for name, value in zip(labelnames, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def samples(self):
+        with _lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield self.name, _label_text(self.labelnames, key), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        super().__init__(name, help, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with _lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, "", self.function()
+            return
+        yield from super().samples()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with _lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][index] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    def time(self, **labels):
+        """Decorator that records how long each call takes"""
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+
+            return wrapper
+
+        return decorator
+
+    def samples(self):
+        with _lock:
+            items = [(key, (list(c[0]), c[1], c[2])) for key, c in self.values.items()]
+        for key, (buckets, count, total) in items:
+            for bound, bucket_count in zip(self.buckets, buckets):
+                labels = _label_text(self.labelnames + ("le",), key + (bound,))
+                yield f"{self.name}_bucket", labels, bucket_count
+            labels = _label_text(self.labelnames + ("le",), key + ("+Inf",))
+            yield f"{self.name}_bucket", labels, count
+            labels = _label_text(self.labelnames, key)
+            yield f"{self.name}_count", labels, count
+            yield f"{self.name}_sum", labels, total
+
+
+def render():
+    lines = []
+    for metric in list(_registry):
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host, port):
+    server = ThreadingHTTPServer((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# metrics shared across modules
+
+db_seconds = Histogram(
+    "redditwatch_db_seconds", "Time spent in utils/db.py calls", ("call",)
+)
+observe_seconds = Histogram(
+    "redditwatch_observe_seconds", "Time spent polling one stream", ("kind",)
+)
+polls = Counter(
+    "redditwatch_polls_total", "Stream polls per redditor", ("redditor", "kind")
+)
+items = Counter(
+    "redditwatch_items_total",
+    "Items returned by a stream per redditor",
+    ("redditor", "kind"),
+)
+alerts = Counter(
+    "redditwatch_alerts_total", "Alerts produced per redditor", ("redditor", "kind")
+)
+last_item = Gauge(
+    "redditwatch_last_item_timestamp",
+    "Unix time the last item was seen per redditor",
+    ("redditor", "kind"),
+)
+reddit_errors = Counter(
+    "redditwatch_reddit_errors_total", "Failed Reddit stream polls", ("kind",)
+)
+telegram_seconds = Histogram(
+    "redditwatch_telegram_seconds", "Telegram API call latency", ("method",)
+)
+telegram_errors = Counter(
+    "redditwatch_telegram_errors_total", "Failed Telegram API calls", ("reason",)
+)
+threads = Gauge(
+    "redditwatch_threads", "Live threads in the process", function=threading.active_count
+)
@@ -0,0 +1,129 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket.
+
+    Callers reserve a token up front and are told how long to wait for it, so
+    concurrent callers are spaced out instead of all waking at once.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def reserve(self):
+        """Take a token and return the seconds to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(0.0, self.paused_until - now)
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def acquire(self, stop_event=None):
+        wait = self.reserve()
+        if wait > 0:
+            if stop_event is not None:
+                stop_event.wait(wait)
+            else:
+                time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """Hold back every caller for ``seconds`` (e.g. after a 429)"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RedditGovernor:
+    """Paces every Reddit request in the process.
+
+    A token bucket enforces REDDIT_MAX_RPM. After each response the bucket
+    rate is lowered to what Reddit's X-Ratelimit-Remaining/Reset headers
+    allow for the rest of the window, so callers are spread across the
+    window instead of burning the quota and then waiting.
+    """
+
+    def __init__(self, max_rpm, reserve):
+        self.max_rate = max_rpm / 60
+        self.reserve_requests = reserve
+        self.bucket = TokenBucket(self.max_rate, capacity=max(1, max_rpm // 10))
+        self.remaining = None
+        self.used = None
+        self.reset_at = None
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def reserve(self):
+        """Count a request and return the seconds the caller has to wait"""
+        wait = self.bucket.reserve()
+        with self._lock:
+            self.requests += 1
+            if wait > 0:
+                self.waited += wait
+        return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            self._stopped.wait(wait)
+
+    def stop(self):
+        """Stop holding callers back, so a shutdown never waits out a 429"""
+        self._stopped.set()
+
+    def update(self, status, headers):
+        try:
+            remaining = float(headers["x-ratelimit-remaining"])
+            reset = float(headers["x-ratelimit-reset"])
+            used = int(float(headers.get("x-ratelimit-used", 0)))
+        except (KeyError, TypeError, ValueError):
+            remaining = reset = used = None
+        with self._lock:
+            if remaining is not None:
+                self.remaining = remaining
+                self.used = used
+                self.reset_at = time.time() + reset
+                budget = remaining - self.reserve_requests
+                rate = budget / reset if reset > 0 else self.max_rate
+                self.bucket.rate = min(self.max_rate, max(rate, 0.01))
+                if budget <= 0:
+                    self.bucket.pause(reset)
+            if status == 429:
+                self.throttled += 1
+                retry_after = headers.get("retry-after")
+                pause = reset if reset is not None else 60
+                self.bucket.pause(float(retry_after) if retry_after else pause)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "seconds_waited": round(self.waited, 1),
+                "remaining": self.remaining,
+                "used": self.used,
+                "reset_in": (
+                    round(max(0.0, self.reset_at - time.time()))
+                    if self.reset_at
+                    else None
+                ),
+                "rate_per_minute": round(self.bucket.rate * 60, 1),
+            }
@@ -0,0 +1,150 @@
+import re
+import threading
+import time
+
+# Alert filter rules. utils/db.py loads the rules table and calls load()
+# after every change; load() compiles all rules into one Matcher, so checking
+# an item costs one set lookup per subreddit rule and a single regex scan of
+# its text however many keywords and tickers there are.
+#
+#   allow / deny      subreddit names; an empty allow list allows all
+#   keyword / ticker  alert only on text containing one of them (keywords
+#                     match case-insensitively, tickers as written, with or
+#                     without a leading $); no keywords or tickers = no check
+#   min_score         drop items scored below this
+#   max_age_hours     drop items older than this
+#   skip_submitter    "on" drops comments made in the redditor's own thread
+
+LIST_KINDS = ("allow", "deny", "keyword", "ticker")
+SETTING_KINDS = ("min_score", "max_age_hours", "skip_submitter")
+KINDS = LIST_KINDS + SETTING_KINDS
+
+DEFAULT_RULES = (
+    ("allow", "wallstreetbets"),
+    ("allow", "thetagang"),
+    ("max_age_hours", "24"),
+    ("skip_submitter", "on"),
+)
+
+
+def normalize(kind, value):
+    """Canonical stored form of a rule value; raises ValueError if invalid"""
+    value = value.strip()
+    if kind in ("allow", "deny"):
+        return value.lower().removeprefix("r/")
+    if kind == "keyword":
+        return value.lower()
+    if kind == "ticker":
+        return value.upper().lstrip("$")
+    if kind == "min_score":
+        return str(int(value))
+    if kind == "max_age_hours":
+        return str(float(value))
+    if kind == "skip_submitter":
+        if value.lower() not in ("on", "off"):
+            raise ValueError(value)
+        return value.lower()
+    raise ValueError(kind)
+
+
+def _trie_pattern(words):
+    """Regex matching any of ``words``, shaped as a trie.
+
+    Alternatives share their prefixes, so the regex engine tries at most one
+    branch per character instead of every word at every position.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return _render(trie)
+
+
+def _render(node):
+    branches = [
+        re.escape(char) + _render(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    if "" in node:
+        return f"(?:{body})?"
+    return body
+
+
+class Matcher:
+    __slots__ = ("allow", "deny", "min_score", "max_age", "skip_submitter", "pattern")
+
+    def __init__(self, rows):
+        values = {kind: [] for kind in KINDS}
+        for kind, value in rows:
+            if kind in values:
+                values[kind].append(value)
+        self.allow = frozenset(values["allow"])
+        self.deny = frozenset(values["deny"])
+        self.min_score = int(values["min_score"][-1]) if values["min_score"] else None
+        self.max_age = (
+            float(values["max_age_hours"][-1]) * 60 * 60
+            if values["max_age_hours"]
+            else None
+        )
+        self.skip_submitter = values["skip_submitter"][-1:] == ["on"]
+        parts = []
+        if values["keyword"]:
+            parts.append(rf"(?i:(?<!\w){_trie_pattern(values['keyword'])}(?!\w))")
+        if values["ticker"]:
+            parts.append(rf"(?<![\w$])\$?{_trie_pattern(values['ticker'])}(?!\w)")
+        self.pattern = re.compile("|".join(parts)) if parts else None
+
+    def allows(self, subreddit, score, created_utc, text, is_submitter=False):
+        subreddit = subreddit.lower()
+        if self.allow and subreddit not in self.allow:
+            return False
+        if subreddit in self.deny:
+            return False
+        if self.skip_submitter and is_submitter:
+            return False
+        if self.max_age is not None and created_utc < time.time() - self.max_age:
+            return False
+        if self.min_score is not None and score < self.min_score:
+            return False
+        return self.pattern is None or self.pattern.search(text) is not None
+
+
+_rows = list(DEFAULT_RULES)
+_matcher = Matcher(_rows)
+_version = 0
+_lock = threading.Lock()
+
+
+def load(rows):
+    """Replace the rules with (kind, value) rows and recompile the matcher"""
+    global _rows, _matcher, _version
+    rows = list(rows)
+    matcher = Matcher(rows)
+    with _lock:
+        _rows = rows
+        _matcher = matcher
+        _version += 1
+
+
+def current():
+    return _matcher
+
+
+def version():
+    """Changes every time the rules do"""
+    return _version
+
+
+def rows():
+    return list(_rows)
+
+
+def subreddits():
+    """Allowed subreddits, or None when every subreddit is allowed"""
+    return sorted(_matcher.allow) or None
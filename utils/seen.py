@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import deque
+
+from utils.db import (
+    init_seen_db,
+    load_seen_db,
+    remove_seen_db,
+    save_seen_db,
+    save_watermark_db,
+)
+from utils.settings import SEEN_RING_SIZE
+
+# Dedup state per (redditor, kind): a bounded ring of recent fullnames plus
+# the newest created_utc seen so far (the watermark). Both are persisted in
+# wsbwatch.db, so streams can start without skip_existing and still only
+# alert on items newer than the watermark that have not been seen before.
+# Redditor names are folded to lower case, like everywhere else.
+
+_rings = {}
+_watermarks = {}
+_lock = threading.Lock()
+
+
+class _Ring:
+    __slots__ = ("order", "members")
+
+    def __init__(self):
+        self.order = deque()
+        self.members = set()
+
+    def add(self, fullname):
+        """Remember ``fullname`` and return the fullname evicted to make room"""
+        self.order.append(fullname)
+        self.members.add(fullname)
+        if len(self.order) > SEEN_RING_SIZE:
+            evicted = self.order.popleft()
+            self.members.discard(evicted)
+            return evicted
+        return None
+
+
+def _name(redditor):
+    return redditor.strip().lower()
+
+
+def load():
+    init_seen_db()
+    items, watermarks = load_seen_db()
+    with _lock:
+        _rings.clear()
+        _watermarks.clear()
+        for redditor, kind, fullname in items:
+            _rings.setdefault((_name(redditor), kind), _Ring()).add(fullname)
+        for redditor, kind, created_utc in watermarks:
+            key = (_name(redditor), kind)
+            _watermarks[key] = max(created_utc, _watermarks.get(key, created_utc))
+
+
+def register(redditor, kind):
+    """Start tracking a stream; a stream never seen before starts at now"""
+    key = (_name(redditor), kind)
+    with _lock:
+        if key in _watermarks:
+            return
+        watermark = _watermarks[key] = time.time()
+    save_watermark_db(redditor, kind, watermark)
+
+
+def watermark(redditor, kind):
+    return _watermarks.get((_name(redditor), kind))
+
+
+def is_new(redditor, kind, fullname, created_utc):
+    """Record an item and return True if it has not been alerted on before"""
+    key = (_name(redditor), kind)
+    register(redditor, kind)
+    with _lock:
+        ring = _rings.setdefault(key, _Ring())
+        if fullname in ring.members:
+            return False
+        watermark = _watermarks[key]
+        if created_utc < watermark:
+            return False
+        evicted = ring.add(fullname)
+        _watermarks[key] = max(watermark, created_utc)
+    save_seen_db(redditor, kind, fullname, created_utc, evicted)
+    return True
+
+
+def forget(redditor):
+    redditor = _name(redditor)
+    with _lock:
+        for key in [key for key in _watermarks if key[0] == redditor]:
+            del _watermarks[key]
+        for key in [key for key in _rings if key[0] == redditor]:
+            del _rings[key]
+    remove_seen_db(redditor)
@@ -0,0 +1,121 @@
+from utils import config
+
+# Optional tuning knobs. Anything not set in utils/config.py falls back to the
+# defaults below so existing config files keep working.
+
+POLL_INTERVAL = getattr(config, "POLL_INTERVAL", 30)
+RETRY_DELAY = getattr(config, "RETRY_DELAY", 10)
+POLLER_WORKERS = getattr(config, "POLLER_WORKERS", 4)
+
+# asyncio runtime (async_main.py)
+ASYNC_MAX_CONCURRENCY = getattr(config, "ASYNC_MAX_CONCURRENCY", 32)
+TELEGRAM_POLL_TIMEOUT = getattr(config, "TELEGRAM_POLL_TIMEOUT", 50)
+COMMAND_WORKERS = getattr(config, "COMMAND_WORKERS", 4)
+
+# "user" polls each watched redditor's own listing, "subreddit" streams the
+# watched subreddits once and matches authors locally
+FETCH_MODE = getattr(config, "FETCH_MODE", "user")
+SUBREDDIT_POLL_INTERVAL = getattr(config, "SUBREDDIT_POLL_INTERVAL", 5)
+WATCHLIST_REFRESH_INTERVAL = getattr(config, "WATCHLIST_REFRESH_INTERVAL", 600)
+# redditors that keep the per-user streams in subreddit mode
+USER_STREAM_REDDITORS = {
+    name.strip().lower() for name in getattr(config, "USER_STREAM_REDDITORS", ())
+}
+
+# Telegram delivery (delivery.py)
+TELEGRAM_API_URL = getattr(config, "TELEGRAM_API_URL", "https://api.telegram.org")
+DELIVERY_WORKERS = getattr(config, "DELIVERY_WORKERS", 8)
+DELIVERY_RETRIES = getattr(config, "DELIVERY_RETRIES", 3)
+TELEGRAM_GLOBAL_RATE = getattr(config, "TELEGRAM_GLOBAL_RATE", 30)
+TELEGRAM_CHAT_INTERVAL = getattr(config, "TELEGRAM_CHAT_INTERVAL", 1.0)
+# stop formatting alerts while this many sends wait in the outbox
+DELIVERY_MAX_PENDING = getattr(config, "DELIVERY_MAX_PENDING", 200)
+
+# digests (pipeline.py): alerts from one redditor in one thread within
+# DIGEST_WINDOW seconds of the first are merged into that first message by
+# editing it. 0 disables digests; ratings of DIGEST_BYPASS_RATING and up are
+# always sent as separate messages.
+DIGEST_WINDOW = getattr(config, "DIGEST_WINDOW", 300)
+DIGEST_BYPASS_RATING = getattr(config, "DIGEST_BYPASS_RATING", 8)
+
+# durable outbox (outbox.py): rows are written and sent OUTBOX_BATCH at a
+# time; a failed send is retried after OUTBOX_BACKOFF seconds, doubling up to
+# OUTBOX_MAX_BACKOFF. Sent rows are kept for OUTBOX_RETENTION seconds.
+OUTBOX_BATCH = getattr(config, "OUTBOX_BATCH", 50)
+OUTBOX_POLL_INTERVAL = getattr(config, "OUTBOX_POLL_INTERVAL", 1)
+OUTBOX_BACKOFF = getattr(config, "OUTBOX_BACKOFF", 5)
+OUTBOX_MAX_BACKOFF = getattr(config, "OUTBOX_MAX_BACKOFF", 600)
+OUTBOX_RETENTION = getattr(config, "OUTBOX_RETENTION", 60 * 60 * 24)
+# how long shutdown may spend flushing queued alerts to the outbox
+SHUTDOWN_TIMEOUT = getattr(config, "SHUTDOWN_TIMEOUT", 30)
+
+# alert pipeline (pipeline.py): at most PIPELINE_QUEUE_SIZE events wait for
+# formatting. When it is full PIPELINE_POLICY decides what gives: "coalesce"
+# folds the event into a queued one from the same redditor, "drop_lowest"
+# drops the lowest-rated event, "spill" appends it to PIPELINE_SPILL_PATH
+PIPELINE_QUEUE_SIZE = getattr(config, "PIPELINE_QUEUE_SIZE", 1000)
+PIPELINE_POLICY = getattr(config, "PIPELINE_POLICY", "coalesce")
+PIPELINE_SPILL_PATH = getattr(config, "PIPELINE_SPILL_PATH", "utils/alert_spill.jsonl")
+
+# activity archive (utils/archive.py): every new item is buffered and written
+# in transactions of up to ARCHIVE_BATCH rows at least every
+# ARCHIVE_FLUSH_INTERVAL seconds; rows older than ARCHIVE_RETENTION seconds
+# are pruned. /search returns at most ARCHIVE_SEARCH_LIMIT results
+ARCHIVE_BATCH = getattr(config, "ARCHIVE_BATCH", 500)
+ARCHIVE_FLUSH_INTERVAL = getattr(config, "ARCHIVE_FLUSH_INTERVAL", 5)
+ARCHIVE_RETENTION = getattr(config, "ARCHIVE_RETENTION", 60 * 60 * 24 * 90)
+ARCHIVE_SEARCH_LIMIT = getattr(config, "ARCHIVE_SEARCH_LIMIT", 10)
+
+# how many recent fullnames to remember per (redditor, kind) for dedup
+SEEN_RING_SIZE = getattr(config, "SEEN_RING_SIZE", 200)
+
+# adaptive polling (scheduler.py): each feed is polled every
+# POLL_GAP_FRACTION of its average gap between items, kept within
+# [POLL_MIN_INTERVAL, POLL_MAX_INTERVAL]. Low-rated redditors get a floor of
+# up to twice POLL_MIN_INTERVAL. POLL_BUDGET_RPM caps polls across all feeds.
+POLL_MIN_INTERVAL = getattr(config, "POLL_MIN_INTERVAL", POLL_INTERVAL)
+POLL_MAX_INTERVAL = getattr(config, "POLL_MAX_INTERVAL", 600)
+POLL_GAP_FRACTION = getattr(config, "POLL_GAP_FRACTION", 0.1)
+POLL_BUDGET_RPM = getattr(config, "POLL_BUDGET_RPM", 60)
+
+# account resolver (resolver.py): whether a redditor exists is cached for
+# RESOLVER_TTL seconds, whether it does not for RESOLVER_NEGATIVE_TTL. Every
+# RESOLVER_SWEEP_INTERVAL seconds the whole watchlist is checked, 100
+# accounts per request; suspended or deleted ones stop being polled
+RESOLVER_TTL = getattr(config, "RESOLVER_TTL", 60 * 60 * 24)
+RESOLVER_NEGATIVE_TTL = getattr(config, "RESOLVER_NEGATIVE_TTL", 60 * 60)
+RESOLVER_SWEEP_INTERVAL = getattr(config, "RESOLVER_SWEEP_INTERVAL", 60 * 60 * 6)
+
+# warm start (scheduler.py): the first polls of newly added feeds are spread
+# over POLL_MIN_INTERVAL, or longer if POLL_BUDGET_RPM cannot cover them in
+# one interval, and at most STREAM_INIT_CONCURRENCY streams run their first
+# (backfill) fetch at once. Every reschedule is jittered by up to POLL_JITTER
+# of its delay so feeds do not drift back into lockstep
+STREAM_INIT_CONCURRENCY = getattr(config, "STREAM_INIT_CONCURRENCY", 2)
+POLL_JITTER = getattr(config, "POLL_JITTER", 0.1)
+
+# sharded mode (shard_main.py): one worker process per entry, each a dict
+# with client_id, client_secret and user_agent for its own Reddit app
+SHARD_CREDENTIALS = list(getattr(config, "SHARD_CREDENTIALS", ()))
+
+# hard ceiling for Reddit requests across every client in the process
+REDDIT_MAX_RPM = getattr(config, "REDDIT_MAX_RPM", 90)
+# keep this many requests of each rate-limit window in reserve
+REDDIT_RESERVE = getattr(config, "REDDIT_RESERVE", 5)
+
+# Telegram updates: "polling" long-polls getUpdates, "webhook" runs a local
+# HTTP receiver (webhook.py) behind WEBHOOK_URL
+TELEGRAM_MODE = getattr(config, "TELEGRAM_MODE", "polling")
+OFFSET_CHECKPOINT_INTERVAL = getattr(config, "OFFSET_CHECKPOINT_INTERVAL", 60)
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)
+WEBHOOK_LISTEN = getattr(config, "WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8443)
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)
+
+# observability: /metrics endpoint (None disables it) and console logging
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9108)
+LOG_LEVEL = getattr(config, "LOG_LEVEL", "INFO")
+# at most LOG_RATE_BURST records per event every LOG_RATE_INTERVAL seconds
+LOG_RATE_BURST = getattr(config, "LOG_RATE_BURST", 20)
+LOG_RATE_INTERVAL = getattr(config, "LOG_RATE_INTERVAL", 60)
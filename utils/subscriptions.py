@@ -0,0 +1,80 @@
+import threading
+
+# Which chats want which alerts. utils/db.py loads the subscriptions table
+# into an inverted index, redditor -> {chat_id: Subscription}, and updates it
+# from /subscribe and /unsubscribe, so routing an alert never touches SQLite.
+# A subscription to ALL matches every redditor.
+
+ALL = "*"
+
+
+class Subscription:
+    __slots__ = ("chat_id", "redditor", "min_rating", "subreddit")
+
+    def __init__(self, chat_id, redditor, min_rating=0, subreddit=None):
+        self.chat_id = chat_id
+        self.redditor = redditor
+        self.min_rating = min_rating
+        self.subreddit = subreddit
+
+    def matches(self, rating, subreddit):
+        if rating < self.min_rating:
+            return False
+        return self.subreddit is None or self.subreddit == subreddit.lower()
+
+
+_index = {}
+_lock = threading.Lock()
+
+
+def _key(redditor):
+    return redditor.strip().lower()
+
+
+def load(rows):
+    """Replace the index with (chat_id, redditor, min_rating, subreddit) rows"""
+    global _index
+    index = {}
+    for chat_id, redditor, min_rating, subreddit in rows:
+        index.setdefault(_key(redditor), {})[chat_id] = Subscription(
+            chat_id, _key(redditor), int(min_rating), subreddit
+        )
+    with _lock:
+        _index = index
+
+
+def put(chat_id, redditor, min_rating=0, subreddit=None):
+    with _lock:
+        _index.setdefault(_key(redditor), {})[chat_id] = Subscription(
+            chat_id, _key(redditor), int(min_rating), subreddit
+        )
+
+
+def discard(chat_id, redditor):
+    with _lock:
+        chats = _index.get(_key(redditor))
+        if chats:
+            chats.pop(chat_id, None)
+            if not chats:
+                del _index[_key(redditor)]
+
+
+def for_chat(chat_id):
+    with _lock:
+        return [
+            chats[chat_id] for chats in _index.values() if chat_id in chats
+        ]
+
+
+def chats_for(redditor, rating, subreddit):
+    """Chat ids that should get an alert from ``redditor`` in ``subreddit``"""
+    with _lock:
+        candidates = list(_index.get(_key(redditor), {}).values())
+        candidates += _index.get(ALL, {}).values()
+    return sorted(
+        {
+            subscription.chat_id
+            for subscription in candidates
+            if subscription.matches(rating, subreddit)
+        }
+    )
@@ -0,0 +1,90 @@
+import threading
+import time
+
+# Process-wide copy of the redditors table. utils/db.py loads it once at
+# startup and updates it from every write, so membership and mute checks
+# never have to touch SQLite. Names match case-insensitively, like the
+# user_name index.
+
+
+class WatchedRedditor:
+    __slots__ = ("name", "rating", "mute_until")
+
+    def __init__(self, name, rating, mute_until=0.0):
+        self.name = name
+        self.rating = rating
+        self.mute_until = mute_until
+
+
+_entries = {}
+_lock = threading.Lock()
+_loaded = False
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _key(name):
+    return name.strip().lower()
+
+
+def load(rows):
+    """Replace the cache with (user_name, rating, mute_timer) rows"""
+    global _entries, _loaded
+    entries = {
+        _key(row[0]): WatchedRedditor(row[0], int(row[1]), _to_float(row[2]))
+        for row in rows
+    }
+    with _lock:
+        _entries = entries
+        _loaded = True
+
+
+def is_loaded():
+    return _loaded
+
+
+def set_rating(name, rating):
+    """Set the rating of ``name``, adding it unmuted if it is not cached"""
+    with _lock:
+        entry = _entries.get(_key(name))
+        if entry:
+            entry.rating = int(rating)
+        else:
+            _entries[_key(name)] = WatchedRedditor(name, int(rating))
+
+
+def discard(name):
+    with _lock:
+        _entries.pop(_key(name), None)
+
+
+def set_mute(name, mute_until):
+    with _lock:
+        entry = _entries.get(_key(name))
+        if entry:
+            entry.mute_until = mute_until
+
+
+def add_rating(name, amount):
+    with _lock:
+        entry = _entries.get(_key(name))
+        if entry:
+            entry.rating += int(amount)
+
+
+def contains(name):
+    return _key(name) in _entries
+
+
+def get(name):
+    return _entries.get(_key(name))
+
+
+def is_muted(name):
+    entry = _entries.get(_key(name))
+    return entry is not None and entry.mute_until > time.time()
@@ -0,0 +1,91 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from telegram import TELEGRAM_URL, get_offset, process_update
+from utils.log import log_event
+from utils.settings import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL
+
+log = logging.getLogger("webhook")
+
+
+class WebhookServer:
+    """Receives Telegram updates pushed to WEBHOOK_URL.
+
+    The server itself speaks plain HTTP on WEBHOOK_LISTEN:WEBHOOK_PORT and is
+    meant to sit behind a TLS-terminating reverse proxy. Telegram only sends
+    one update at a time (max_connections=1), so commands keep their order.
+    """
+
+    def __init__(self, reddit, created_redditor_queue, removed_redditor_queue):
+        self.reddit = reddit
+        self.created_redditor_queue = created_redditor_queue
+        self.removed_redditor_queue = removed_redditor_queue
+        self.server = ThreadingHTTPServer(
+            (WEBHOOK_LISTEN, WEBHOOK_PORT), self._handler_class()
+        )
+        self._thread = None
+
+    def _handler_class(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token")
+                if WEBHOOK_SECRET and secret != WEBHOOK_SECRET:
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    update = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                # acknowledge first so Telegram does not resend while we work
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.flush()
+                webhook.handle(update)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def handle(self, update):
+        try:
+            process_update(
+                update,
+                self.reddit,
+                self.created_redditor_queue,
+                self.removed_redditor_queue,
+            )
+        except Exception:
+            logging.error("An error occurred handling a webhook update", exc_info=True)
+
+    def start(self):
+        get_offset()
+        params = {"url": WEBHOOK_URL, "max_connections": 1}
+        if WEBHOOK_SECRET:
+            params["secret_token"] = WEBHOOK_SECRET
+        response = requests.post(f"{TELEGRAM_URL}/setWebhook", data=params).json()
+        log_event(log, logging.INFO, "webhook_set", ok=response.get("ok"))
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="telegram-webhook"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        # drop the webhook so a later start in polling mode gets updates again
+        response = requests.post(f"{TELEGRAM_URL}/deleteWebhook").json()
+        log_event(log, logging.INFO, "webhook_deleted", ok=response.get("ok"))
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread:
+            self._thread.join()